@@ -1,9 +1,39 @@
+import hashlib
 import os
+import time
 
-from flask import Flask
+from flask import Flask, Response, request
+
+from app.metrics import Metrics, instrument, server_timing
 
 INSTANCE_ID = os.environ.get("INSTANCE_ID", "unknown")
 ROUTE_RULE = os.environ.get("ROUTE_RULE", "/")
+# Set APP_FAST_PATH=1 to answer ROUTE_RULE and /health without going through
+# Flask
+FAST_PATH = os.environ.get("APP_FAST_PATH", "0") == "1"
+# Set APP_METRICS=0 to not count the requests reported on /metrics
+METRICS = os.environ.get("APP_METRICS", "1") == "1"
+# Set APP_SERVER_TIMING=0 to not add the Server-Timing and X-Instance-Id
+# headers to the responses
+SERVER_TIMING = os.environ.get("APP_SERVER_TIMING", "1") == "1"
+
+# Defaults of the synthetic workload routes, overridden by the query string
+CPU_ITERATIONS = int(os.environ.get("APP_CPU_ITERATIONS", "10000"))
+IO_MS = float(os.environ.get("APP_IO_MS", "50"))
+PAYLOAD_BYTES = int(os.environ.get("APP_PAYLOAD_BYTES", str(1 << 20)))
+ALLOC_MB = int(os.environ.get("APP_ALLOC_MB", "16"))
+# Maximums of the query string values, so that a request cannot hold a
+# worker thread or the memory of the instance for too long
+MAX_CPU_ITERATIONS = int(os.environ.get("APP_MAX_CPU_ITERATIONS",
+                                        "1000000"))
+MAX_IO_MS = float(os.environ.get("APP_MAX_IO_MS", "10000"))
+MAX_PAYLOAD_BYTES = int(os.environ.get("APP_MAX_PAYLOAD_BYTES",
+                                       str(256 << 20)))
+MAX_ALLOC_MB = int(os.environ.get("APP_MAX_ALLOC_MB", "512"))
+PAYLOAD_CHUNK = b"x" * (64 << 10)
+WORKLOAD_ROUTES = tuple(f"{ROUTE_RULE.rstrip('/')}/{name}"
+                        for name in ("cpu", "io", "payload", "alloc"))
+CPU_ROUTE, IO_ROUTE, PAYLOAD_ROUTE, ALLOC_ROUTE = WORKLOAD_ROUTES
 
 app = Flask(__name__)
 
@@ -16,3 +46,99 @@ def hello_world():
 @app.route("/health")
 def health():
     return "OK"
+
+
+@app.route(CPU_ROUTE)
+def cpu():
+    """Chain of SHA-256 hashes, the GIL being held"""
+    iterations = _clamp(request.args.get(
+        "iterations", CPU_ITERATIONS, type=int), MAX_CPU_ITERATIONS)
+    digest = INSTANCE_ID.encode()
+    for _ in range(iterations):
+        digest = hashlib.sha256(digest).digest()
+    return f"{iterations} hashes on {INSTANCE_ID}: {digest.hex()}"
+
+
+@app.route(IO_ROUTE)
+def io_route():
+    """Wait without using the CPU, like a call to a database"""
+    ms = _clamp(request.args.get("ms", IO_MS, type=float), MAX_IO_MS)
+    time.sleep(ms / 1000)
+    return f"Waited {ms} ms on {INSTANCE_ID}"
+
+
+@app.route(PAYLOAD_ROUTE)
+def payload():
+    """Response of the given size, streamed by chunks"""
+    size = _clamp(request.args.get("bytes", PAYLOAD_BYTES, type=int),
+                  MAX_PAYLOAD_BYTES)
+
+    def chunks():
+        for _ in range(size // len(PAYLOAD_CHUNK)):
+            yield PAYLOAD_CHUNK
+        yield PAYLOAD_CHUNK[:size % len(PAYLOAD_CHUNK)]
+
+    return Response(chunks(), mimetype="application/octet-stream",
+                    headers={"Content-Length": str(size)})
+
+
+@app.route(ALLOC_ROUTE)
+def alloc():
+    """Allocate and touch memory, freed at the end of the request"""
+    mb = _clamp(request.args.get("mb", ALLOC_MB, type=int), MAX_ALLOC_MB)
+    buffer = bytearray(mb << 20)
+    buffer[::4096] = b"\x01" * len(range(0, len(buffer), 4096))
+    return f"Allocated {mb} MB on {INSTANCE_ID}"
+
+
+def _clamp(value, maximum):
+    return min(max(0, value), maximum)
+
+
+request_metrics = Metrics((ROUTE_RULE, *WORKLOAD_ROUTES, "/health",
+                           "/metrics"))
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(request_metrics.render(INSTANCE_ID),
+                    mimetype="text/plain; version=0.0.4")
+
+
+class FastPath:
+    """WSGI middleware answering GET and HEAD requests on fixed paths with
+    responses built once, other requests are passed to `fallback`"""
+
+    def __init__(self, fallback, bodies: dict[str, str]):
+        self.fallback = fallback
+        self.responses = {
+            path: ([
+                ("Content-Type", "text/html; charset=utf-8"),
+                ("Content-Length", str(len(body.encode()))),
+            ], [body.encode()])
+            for path, body in bodies.items()
+        }
+
+    def __call__(self, environ, start_response):
+        response = self.responses.get(environ["PATH_INFO"])
+        method = environ["REQUEST_METHOD"]
+        if response is None or method not in ("GET", "HEAD"):
+            return self.fallback(environ, start_response)
+        headers, body = response
+        start_response("200 OK", headers)
+        return body if method == "GET" else []
+
+
+def fast_path(wsgi_app):
+    return FastPath(wsgi_app, {
+        ROUTE_RULE: hello_world(),
+        "/health": health(),
+    })
+
+
+if FAST_PATH:
+    app.wsgi_app = fast_path(app.wsgi_app)
+if METRICS:
+    app.wsgi_app = instrument(app.wsgi_app, request_metrics)
+if SERVER_TIMING:
+    app.wsgi_app = server_timing(app.wsgi_app, INSTANCE_ID)
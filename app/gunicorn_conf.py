@@ -0,0 +1,56 @@
+"""gunicorn settings of the app: `gunicorn -c python:app.gunicorn_conf app:app`
+
+Every setting can be overridden with the matching APP_* environment variable.
+The defaults use all the CPUs of the instance.
+"""
+import os
+import shutil
+import tempfile
+
+# CPUs this process may run on (cgroup cpusets included)
+_CPUS = len(os.sched_getaffinity(0))
+
+bind = os.environ.get('APP_BIND', '0.0.0.0:8000')
+# sync, gthread or gevent
+worker_class = os.environ.get('APP_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('APP_WORKERS', str(2 * _CPUS + 1)))
+# Threads per worker, only used by gthread
+threads = int(os.environ.get('APP_THREADS', '4'))
+# Connections per worker, only used by gevent
+worker_connections = int(os.environ.get('APP_WORKER_CONNECTIONS', '1000'))
+# Longer than the 60 s idle timeout of the load balancer, so that gunicorn
+# never closes a connection the load balancer is about to reuse
+keepalive = int(os.environ.get('APP_KEEPALIVE', '65'))
+backlog = int(os.environ.get('APP_BACKLOG', '2048'))
+# Import the app once in the master and fork the workers from it
+preload_app = os.environ.get('APP_PRELOAD', '1') == '1'
+
+# Directory of the request counters of the workers (see app.metrics),
+# created by the master unless set
+_metrics_dir = os.environ.get('APP_METRICS_DIR')
+
+
+def on_starting(server):
+    if _metrics_dir is None:
+        os.environ['APP_METRICS_DIR'] = tempfile.mkdtemp(prefix='app-metrics-')
+
+
+def post_fork(server, worker):
+    from app import request_metrics
+    request_metrics.open(os.environ['APP_METRICS_DIR'])
+
+
+def worker_exit(server, worker):
+    from app import request_metrics
+    request_metrics.flush()
+
+
+def child_exit(server, worker):
+    from app import request_metrics
+    from app.metrics import worker_exited
+    worker_exited(os.environ['APP_METRICS_DIR'], worker.pid, request_metrics)
+
+
+def on_exit(server):
+    if _metrics_dir is None:
+        shutil.rmtree(os.environ['APP_METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,195 @@
+import mmap
+import os
+import threading
+from array import array
+from pathlib import Path
+from time import perf_counter_ns, sleep
+
+try:
+    # Once gevent patches threading, get_ident is the ID of the greenlet
+    from gevent.monkey import get_original
+    _get_ident = get_original("threading", "get_ident")
+except ImportError:
+    _get_ident = threading.get_ident
+
+# Latency histogram buckets: bucket k counts the durations below 2^(k + 10) ns
+# (about 2^k µs, up to 8.6 s), the last one counts the longer ones
+BUCKETS = 24
+OTHER_ROUTE = "other"
+
+# Values of a route: requests started, requests done, duration sum (ns),
+# bucket counts. There is a slot for any bit length of a duration, which
+# is cheaper than bounding it; the slots above BUCKETS are added together.
+_STARTED = 0
+_DONE = 1
+_SUM = 2
+_BUCKETS = 3
+_ROUTE_SIZE = _BUCKETS + 64
+
+
+class Metrics:
+    """Request counters of the routes.
+
+    Counters are integers of a list, the cheapest to increment. gthread
+    workers serve requests from several threads, so each OS thread
+    increments its own list of `thread_values`, without a lock, and
+    `values` adds them up. The greenlets of a gevent worker share the list
+    of their thread, as they only switch on I/O. Once a
+    gunicorn worker calls `open`, a thread copies them every
+    `flush_interval` seconds to `<directory>/<pid>.bin`, so that any worker
+    can report the counters of all of them.
+    """
+
+    def __init__(self, routes: tuple[str, ...], flush_interval: float = 1.):
+        self.routes = (*routes, OTHER_ROUTE)
+        self.size = len(self.routes) * _ROUTE_SIZE
+        self.flush_interval = flush_interval
+        self.directory: Path | None = None
+        self.thread_values: dict[int, list[int]] = {}
+        self._mmap: mmap.mmap | None = None
+
+    @property
+    def values(self):
+        return [sum(values)
+                for values in zip(*list(self.thread_values.values()))] \
+            or [0] * self.size
+
+    def add_thread(self):
+        """Counters of the current OS thread, kept for the next thread
+        reusing its ID"""
+        return self.thread_values.setdefault(_get_ident(), [0] * self.size)
+
+    def open(self, directory: str):
+        """Copy the counters of this process to `directory` from now on"""
+        self.directory = Path(directory)
+        path = self.directory / f"{os.getpid()}.bin"
+        with open(path, "w+b") as f:
+            f.truncate(self.size * 8)
+            self._mmap = mmap.mmap(f.fileno(), self.size * 8)
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap[:] = array("q", self.values).tobytes()
+
+    def collect(self):
+        """Counters of each worker by pid"""
+        if self.directory is None:
+            return {os.getpid(): self.values}
+        self.flush()
+        workers = {}
+        for path in self.directory.glob("*.bin"):
+            data = path.read_bytes()
+            if len(data) == self.size * 8:
+                workers[int(path.stem)] = array("q", data).tolist()
+        return workers
+
+    def render(self, instance_id: str):
+        """Counters of all the workers in the Prometheus text format"""
+        workers = self.collect()
+        totals = [sum(values) for values in zip(*workers.values())]
+        routes = list(enumerate(self.routes))
+        lines = [
+            "# TYPE app_info gauge",
+            f'app_info{{instance_id="{instance_id}"}} 1',
+            "# TYPE app_requests_total counter",
+            *(f'app_requests_total{{route="{route}"}} '
+              f"{totals[i * _ROUTE_SIZE + _DONE]}"
+              for i, route in routes),
+            "# TYPE app_requests_in_flight gauge",
+            *(f'app_requests_in_flight{{route="{route}"}} '
+              f"{totals[i * _ROUTE_SIZE + _STARTED] - totals[i * _ROUTE_SIZE + _DONE]}"  # noqa: E501
+              for i, route in routes),
+            "# TYPE app_request_duration_seconds histogram",
+        ]
+        bounds = [str((1 << (k + 10)) / 1e9) for k in range(BUCKETS)]
+        for i, route in routes:
+            base = i * _ROUTE_SIZE
+            cumulative = 0
+            for k, bound in enumerate(bounds):
+                cumulative += totals[base + _BUCKETS + k]
+                lines.append(
+                    "app_request_duration_seconds_bucket"
+                    f'{{route="{route}",le="{bound}"}} {cumulative}')
+            lines.append(
+                "app_request_duration_seconds_bucket"
+                f'{{route="{route}",le="+Inf"}} {totals[base + _DONE]}')
+            lines.append(f'app_request_duration_seconds_sum{{route="{route}"}}'
+                         f" {totals[base + _SUM] / 1e9}")
+            lines.append(
+                f'app_request_duration_seconds_count{{route="{route}"}}'
+                f" {totals[base + _DONE]}")
+        lines.append("# TYPE app_worker_requests_total counter")
+        for pid, values in sorted(workers.items()):
+            lines.append(f'app_worker_requests_total{{worker="{pid}"}} '
+                         f"{sum(values[_DONE::_ROUTE_SIZE])}")
+        return "\n".join(lines) + "\n"
+
+    def _flush_loop(self):
+        while True:
+            sleep(self.flush_interval)
+            self.flush()
+
+
+def instrument(wsgi_app, metrics: Metrics):
+    """Wrap `wsgi_app` to count its requests in `metrics`, the duration being
+    measured until it returns its body. A closure is cheaper to call than a
+    class instance."""
+    route_offset = {route: i * _ROUTE_SIZE
+                    for i, route in enumerate(metrics.routes)}.get
+    other = metrics.routes.index(OTHER_ROUTE) * _ROUTE_SIZE
+    thread_values = metrics.thread_values.get
+    get_ident = _get_ident
+
+    def instrumented(environ, start_response):
+        values = thread_values(get_ident()) or metrics.add_thread()
+        base = route_offset(environ["PATH_INFO"], other)
+        values[base] += 1
+        start = perf_counter_ns()
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            duration = perf_counter_ns() - start
+            values[base + _DONE] += 1
+            values[base + _SUM] += duration
+            values[base + _BUCKETS + (duration >> 10).bit_length()] += 1
+
+    instrumented.wrapped = wsgi_app
+    return instrumented
+
+
+def server_timing(wsgi_app, instance_id: str):
+    """Wrap `wsgi_app` to add to its responses the time it took until it
+    started the response, as `Server-Timing: app;dur=<ms>`, and the ID of
+    the instance as `X-Instance-Id`"""
+    instance_header = ("X-Instance-Id", instance_id)
+
+    def timed(environ, start_response):
+        start = perf_counter_ns()
+
+        def timed_start_response(status, headers, exc_info=None):
+            duration = (perf_counter_ns() - start) / 1e6
+            return start_response(status, [
+                *headers,
+                ("Server-Timing", f"app;dur={duration:.3f}"),
+                instance_header,
+            ], exc_info)
+
+        return wsgi_app(environ, timed_start_response)
+
+    timed.wrapped = wsgi_app
+    return timed
+
+
+def worker_exited(directory: str, pid: int, metrics: Metrics):
+    """Mark the requests in flight of a dead worker as done, so that its
+    counters are kept but it has no more requests in flight"""
+    path = Path(directory) / f"{pid}.bin"
+    if not path.exists():
+        return
+    with open(path, "r+b") as f, mmap.mmap(f.fileno(), 0) as m:
+        values = array("q", m[:])
+        for i in range(len(metrics.routes)):
+            base = i * _ROUTE_SIZE
+            values[base + _STARTED] = values[base + _DONE]
+        m[:] = values.tobytes()
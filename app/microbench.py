@@ -0,0 +1,78 @@
+"""CPU time per request of the Flask routes, of the fast path and of the
+fast path with the request metrics
+
+python3 -m app.microbench [-n REQUESTS]
+"""
+import argparse
+import io
+import sys
+import time
+
+from app import ROUTE_RULE, FastPath, app, fast_path, request_metrics
+from app.metrics import Metrics, instrument
+
+
+def _environ(path: str):
+    return {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8000",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": "localhost:8000",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench(wsgi_app, path: str, nb_requests: int):
+    """CPU time (s) of one request, body iteration and close included"""
+    environ = _environ(path)
+    start = time.process_time()
+    for _ in range(nb_requests):
+        body = wsgi_app(dict(environ), _start_response)
+        for _ in body:
+            pass
+        if hasattr(body, "close"):
+            body.close()
+    return (time.process_time() - start) / nb_requests
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m app.microbench")
+    parser.add_argument("-n", "--requests", type=int, default=100_000,
+                        help="requests per measure (default: %(default)s)")
+    args = parser.parse_args()
+
+    flask_app = app.wsgi_app
+    while hasattr(flask_app, "wrapped"):
+        flask_app = flask_app.wrapped
+    if isinstance(flask_app, FastPath):
+        flask_app = flask_app.fallback
+    metrics = Metrics(request_metrics.routes[:-1])
+    variants = {
+        "flask": flask_app,
+        "fast path": fast_path(flask_app),
+        "fast path + metrics": instrument(fast_path(flask_app), metrics),
+    }
+    for path in (ROUTE_RULE, "/health"):
+        costs = {name: bench(wsgi_app, path, args.requests)
+                 for name, wsgi_app in variants.items()}
+        print(f"{path}: " + ", ".join(
+            f"{name} {cost * 1e6:.2f} µs" for name, cost in costs.items())
+            + f" ({costs['flask'] / costs['fast path']:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,92 @@
+import argparse
 import logging
 from datetime import datetime
+from pathlib import Path
 
-from bench.analysis import analyze
+from bench.analysis import (
+    analyze,
+    analyze_local,
+    save_app_metrics,
+    save_client_stats,
+)
 from bench.config import (
-    CLUSTER_1_PATH,
     CLUSTER_1_TARGET_NAME,
-    CLUSTER_2_PATH,
     CLUSTER_2_TARGET_NAME,
     LB_NAME,
+    LOCAL_LB_ADDRESS,
     LOG_LEVEL,
+    REQUEST_LOG,
+    SCRAPE,
+    WORKERS,
+)
+from bench.scrape import Scraper
+from bench.summary import summarize
+from bench.utils import (
+    get_instance_addresses,
+    get_lb_arn_dns,
+    get_local_targets,
+    get_tg_arn,
+    results_dir,
+    wait_lb,
+    wait_targets_healthy,
 )
-from bench.scenarios import run_scenarios
-from bench.utils import get_lb_arn_dns, get_tg_arn, wait_lb
+from bench.workers import run_workers
+from bench.workload import DEFAULT_WORKLOAD, load_workload
 
 logger = logging.getLogger(__name__)
 
 
 def main():
-    wait_lb(LB_NAME)
-    lb_arn, lb_dns = get_lb_arn_dns(LB_NAME)
-    logger.info(f"{(lb_arn, lb_dns)=}")
+    parser = argparse.ArgumentParser(prog='python3 -m bench')
+    parser.add_argument('workload', nargs='?', type=Path,
+                        default=DEFAULT_WORKLOAD,
+                        help='TOML workload definition (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='number of load generating processes '
+                             '(default: %(default)s)')
+    parser.add_argument('--local', nargs='?', const=LOCAL_LB_ADDRESS,
+                        metavar='ADDRESS',
+                        help='use the local load balancer started with '
+                             f'`python3 -m bench.localalb` ({LOCAL_LB_ADDRESS})'
+                             ' instead of AWS')
+    args = parser.parse_args()
+    workload = load_workload(args.workload)
+
+    if args.local is not None:
+        lb_arn, lb_dns = None, args.local
+    else:
+        wait_lb(LB_NAME)
+        wait_targets_healthy([CLUSTER_1_TARGET_NAME, CLUSTER_2_TARGET_NAME])
+        lb_arn, lb_dns = get_lb_arn_dns(LB_NAME)
+        logger.info(f"{(lb_arn, lb_dns)=}")
 
-    # Run scenarios
+    # Run scenarios, scraping the app instances meanwhile
+    instances = {}
+    if SCRAPE:
+        instances = get_local_targets(lb_dns) if lb_arn is None \
+            else get_instance_addresses(LB_NAME)
     start_time = datetime.utcnow()
-    for cluster in (CLUSTER_1_PATH, CLUSTER_2_PATH):
-        run_scenarios(lb_dns, cluster)
+    log_dir = results_dir(start_time) / 'requests' if REQUEST_LOG else None
+    client_stats = {}
+    with Scraper(instances) as scraper:
+        for cluster in workload.targets:
+            client_stats[cluster] = run_workers(
+                lb_dns, cluster, workload, args.workers, log_dir)
     end_time = datetime.utcnow()
+    save_client_stats(start_time, client_stats)
+    save_app_metrics(start_time, scraper.samples)
 
     # Analyze metrics
     logger.info('Starting analysis')
-    tg1_arn = get_tg_arn(CLUSTER_1_TARGET_NAME)
-    tg2_arn = get_tg_arn(CLUSTER_2_TARGET_NAME)
-    logger.info(f"{(tg1_arn, tg2_arn)=}")
-    for tg_arn in (tg1_arn, tg2_arn, None):
-        analyze(lb_arn, start_time, end_time, tg_arn=tg_arn)
+    if lb_arn is None:
+        analyze_local(lb_dns, start_time, end_time,
+                      [CLUSTER_1_TARGET_NAME, CLUSTER_2_TARGET_NAME, None])
+    else:
+        tg1_arn = get_tg_arn(CLUSTER_1_TARGET_NAME)
+        tg2_arn = get_tg_arn(CLUSTER_2_TARGET_NAME)
+        logger.info(f"{(tg1_arn, tg2_arn)=}")
+        analyze(lb_arn, start_time, end_time, [tg1_arn, tg2_arn, None])
+    summarize(results_dir(start_time))
 
     logger.info('Done. Please check the contents of the `./results` directory.')
 
@@ -1,19 +1,36 @@
 import logging
-import os
-from datetime import datetime
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 from typing import TYPE_CHECKING
 
-import matplotlib.pyplot as plt
-import numpy as np
-import orjson
-
-from bench.config import GRAPH_INFO
-from bench.utils import cw_cli, specifier_from_arn, target_group_name_from_arn
+from bench.cache import MetricCache
+from bench.config import (
+    CW_CACHE,
+    CW_CACHE_PATH,
+    CW_MAX_POINTS,
+    CW_MAX_QUERIES_PER_CALL,
+    CW_MAX_WORKERS,
+    GRAPH_INFO,
+    RESULTS_STORE,
+)
+from bench.engine import PhaseStats
+from bench.render import BarGraph, render_graphs
+from bench.store import ResultStore
+from bench.utils import (
+    cw_cli,
+    get_local_metric_data,
+    results_dir,
+    specifier_from_arn,
+    target_group_name_from_arn,
+)
 
 if TYPE_CHECKING:
     from mypy_boto3_cloudwatch.type_defs import (
         DimensionTypeDef,
+        MetricDataQueryTypeDef,
         MetricDataResultTypeDef,
     )
 
@@ -23,15 +40,60 @@ logger = logging.getLogger(__name__)
 def analyze(lb_arn: str,
             start_time: datetime,
             end_time: datetime,
-            tg_arn: str | None = None):
-    data, path = _save_metrics_data(
-        lb_arn, start_time, end_time, tg_arn=tg_arn)
-    _generate_graph(path.parent, data, tg_arn)
+            tg_arns: list[str | None]):
+    """Fetch, save and graph the metrics of each target group (or of the
+    whole load balancer for `None`), fetching them concurrently"""
+    metric_cache = MetricCache(Path(CW_CACHE_PATH)) if CW_CACHE else None
+    with ThreadPoolExecutor(max_workers=CW_MAX_WORKERS) as executor:
+        all_data = list(executor.map(
+            lambda tg_arn: _get_metric_data(
+                lb_arn, start_time, end_time, tg_arn, metric_cache),
+            tg_arns))
+    graphs: list[BarGraph] = []
+    for tg_arn, data in zip(tg_arns, all_data):
+        _save_metrics_data(data, start_time, tg_arn=tg_arn)
+        graphs += _graphs(results_dir(start_time), data, tg_arn)
+    render_graphs(graphs)
+
+
+def analyze_local(lb_address: str,
+                  start_time: datetime,
+                  end_time: datetime,
+                  tg_names: list[str | None]):
+    """Same as `analyze` with the metrics of the local load balancer"""
+    graphs: list[BarGraph] = []
+    for tg_name in tg_names:
+        data = get_local_metric_data(
+            lb_address, start_time, end_time, tg_name)
+        _save_metrics_data(data, start_time, tg_arn=tg_name)
+        graphs += _graphs(results_dir(start_time), data, tg_name)
+    render_graphs(graphs)
+
+
+def save_client_stats(start_time: datetime,
+                      stats: dict[str, dict[str, PhaseStats]]):
+    """Save the client-side statistics of each cluster path and phase"""
+    run_dir = results_dir(start_time)
+    with _store(run_dir) as store:
+        store.add_client(run_dir.name, {
+            cluster: {phase: s.to_dict() for phase, s in phases.items()}
+            for cluster, phases in stats.items()
+        })
 
 
-def _generate_graph(basedir: Path,
-                    data: list['MetricDataResultTypeDef'],
-                    tg_arn: str | None = None):
+def save_app_metrics(start_time: datetime,
+                     samples: list[tuple[str, float, str, str, float]]):
+    """Save the samples scraped from the /metrics endpoint of the app"""
+    run_dir = results_dir(start_time)
+    with _store(run_dir) as store:
+        store.add_app_metrics(run_dir.name, samples)
+
+
+def _graphs(basedir: Path,
+            data: list['MetricDataResultTypeDef'],
+            tg_arn: str | None = None):
+    suffix = target_group_name_from_arn(tg_arn)
+    graphs: list[BarGraph] = []
     for item in data:
         label = item.get('Label')
         timestamps = item.get('Timestamps')
@@ -41,68 +103,36 @@ def _generate_graph(basedir: Path,
             raise ValueError(
                 f"Missing label, timestamps or values for {item=}")
 
-        active_connection_timestamps = list(
-            map(lambda t: t.strftime(r'%Y-%m-%d %H:%M'), reversed(timestamps)))
-        active_connection_values = list(reversed(values))
-
-        if len(active_connection_timestamps) > 0:
-            x_axis = np.arange(len(timestamps))
-            _create_graph(basedir,
-                          active_connection_timestamps,
-                          active_connection_values,
-                          x_axis,
-                          label,
-                          tg_arn)
-
-
-def _addLabels(x: list[str], y: list[float]):
-    """Add value labels in the graph"""
-    for i in range(len(x)):
-        plt.text(i, y[i], str(y[i]), ha='center')
-
+        if len(timestamps) > 0:
+            graphs.append(BarGraph(
+                path=basedir / f"{suffix}_{label}.png",
+                xlabel=GRAPH_INFO[label]['XLABEL'],
+                ylabel=GRAPH_INFO[label]['YLABEL'],
+                abscissa=[t.strftime(r'%Y-%m-%d %H:%M')
+                          for t in reversed(timestamps)],
+                ordinate=list(reversed(values)),
+            ))
+    return graphs
 
-def _create_graph(basedir: Path,
-                  abscissa: list[str],
-                  ordinate: list[float],
-                  x_axis: np.ndarray,
-                  itemLabel: str,
-                  tg_arn: str | None = None):
-    fig = plt.figure(figsize=(10, 10))
-    # fig.suptitle(GRAPH_INFO[itemLabel]['TITLE'])
-    ax = fig.add_subplot(111)
-    ax.bar(abscissa, ordinate)
-    ax.set_xticklabels(abscissa, rotation=45)
-    _addLabels(abscissa, ordinate)
-    plt.xlabel(GRAPH_INFO[itemLabel]['XLABEL'])
-    plt.ylabel(GRAPH_INFO[itemLabel]['YLABEL'])
-    plt.plot(x_axis, ordinate, color="red")
 
-    suffix = target_group_name_from_arn(tg_arn)
-
-    plt.savefig(basedir / f"{suffix}_{itemLabel}.png")
-    # plt.show()
-
-
-def _save_metrics_data(lb_arn: str,
+def _save_metrics_data(data: list['MetricDataResultTypeDef'],
                        start_time: datetime,
-                       end_time: datetime,
                        tg_arn: str | None = None):
-    data = _get_metric_data(lb_arn, start_time, end_time, tg_arn)
-    base_dir = Path(f"./results/{start_time.strftime(r'%Y-%m-%dT%H_%M')}")
-    if not base_dir.exists():
-        os.mkdir(base_dir)
-    filename = f"{target_group_name_from_arn(tg_arn)}.json"
-    path = base_dir / filename
-    with open(path, 'wb') as f:
-        dump = orjson.dumps(data)
-        f.write(dump)
-    return data, path
+    run_dir = results_dir(start_time)
+    with _store(run_dir) as store:
+        store.add_metrics(
+            run_dir.name, target_group_name_from_arn(tg_arn), data)
+
+
+def _store(run_dir: Path):
+    return ResultStore(run_dir.parent / RESULTS_STORE)
 
 
 def _get_metric_data(lb_arn: str,
                      start_time: datetime,
                      end_time: datetime,
-                     tg_arn: str | None = None):
+                     tg_arn: str | None = None,
+                     metric_cache: MetricCache | None = None):
     lb_specifier = specifier_from_arn(lb_arn)
     dimensions: list['DimensionTypeDef'] = [
         {
@@ -116,164 +146,93 @@ def _get_metric_data(lb_arn: str,
             'Name': 'TargetGroup',
             'Value': tg_specifier
         })
-    data = cw_cli.get_metric_data(
-        MetricDataQueries=[
-            {
-                'Id': 'myrequest_RequestCount',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'RequestCount',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_ActiveConnectionCount',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'ActiveConnectionCount',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_ConsumedLCUs',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'ConsumedLCUs',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_HTTP_Redirect_Count',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'HTTP_Redirect_Count',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_RuleEvaluations',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'RuleEvaluations',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_ProcessedBytes',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'ProcessedBytes',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Bytes'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_HTTPCode_Target_2XX_Count',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'HTTPCode_Target_2XX_Count',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_HealthyHostCount',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'HealthyHostCount',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Average',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_TargetConnectionErrorCount',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'TargetConnectionErrorCount',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Sum',
-                    'Unit': 'Count'
+    queries = _build_queries(dimensions, _choose_period(start_time, end_time))
+    if metric_cache is None:
+        return _fetch_batched(queries, start_time, end_time)
+
+    # Only fetch the time ranges missing from the cache,
+    # grouping the queries missing the same ranges
+    missing = defaultdict(list)
+    for query in queries:
+        for time_range in metric_cache.missing(query, start_time, end_time):
+            missing[time_range].append(query)
+    for (start, end), missing_queries in missing.items():
+        logger.info(f"Fetching {len(missing_queries)} metrics "
+                    f"from {start} to {end}")
+        by_id = {query['Id']: query for query in missing_queries}
+        for result in _fetch_batched(missing_queries, start, end):
+            metric_cache.store(by_id[result['Id']], start, end, result)
+    return [metric_cache.load(query, start_time, end_time)
+            for query in queries]
+
+
+def _fetch_batched(queries: list['MetricDataQueryTypeDef'],
+                   start_time: datetime,
+                   end_time: datetime):
+    results: list['MetricDataResultTypeDef'] = []
+    for i in range(0, len(queries), CW_MAX_QUERIES_PER_CALL):
+        results += _fetch_metric_data(
+            queries[i:i + CW_MAX_QUERIES_PER_CALL], start_time, end_time)
+    return results
+
+
+def _build_queries(dimensions: list['DimensionTypeDef'], period: int):
+    queries: list['MetricDataQueryTypeDef'] = []
+    for label, info in GRAPH_INFO.items():
+        queries.append({
+            'Id': f"q_{label.lower()}",
+            'Label': label,
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/ApplicationELB',
+                    'MetricName': info.get('METRIC', label),
+                    'Dimensions': dimensions
                 },
-                'ReturnData': True,
+                'Period': period,
+                'Stat': info['STAT'],
+                'Unit': info['UNIT']
             },
-            {
-                'Id': 'myrequest_TargetResponseTime',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'TargetResponseTime',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Average',
-                    'Unit': 'Seconds'
-                },
-                'ReturnData': True,
-            },
-            {
-                'Id': 'myrequest_UnHealthyHostCount',
-                'MetricStat': {
-                    'Metric': {
-                        'Namespace': 'AWS/ApplicationELB',
-                        'MetricName': 'UnHealthyHostCount',
-                        'Dimensions': dimensions
-                    },
-                    'Period': 60,
-                    'Stat': 'Average',
-                    'Unit': 'Count'
-                },
-                'ReturnData': True,
-            },
-        ],
-        StartTime=start_time,
-        EndTime=end_time,
-    )
-    return data['MetricDataResults']
+            'ReturnData': True,
+        })
+    return queries
+
+
+def _choose_period(start_time: datetime, end_time: datetime):
+    """Smallest period (multiple of a minute) giving at most `CW_MAX_POINTS`
+    points per series and available for data as old as `start_time`"""
+    minutes = (end_time - start_time).total_seconds() / 60
+    period = 60 * max(1, math.ceil(minutes / CW_MAX_POINTS))
+    # CloudWatch only keeps 1-minute points for 15 days
+    # and 5-minute points for 63 days
+    age = datetime.utcnow() - start_time
+    if age > timedelta(days=63):
+        period = max(period, 3600)
+    elif age > timedelta(days=15):
+        period = max(period, 300)
+    return period
+
+
+def _fetch_metric_data(queries: list['MetricDataQueryTypeDef'],
+                       start_time: datetime,
+                       end_time: datetime):
+    """Call `get_metric_data` and follow `NextToken` until all the points
+    are fetched, merging the pages of each query"""
+    results: dict[str, 'MetricDataResultTypeDef'] = {}
+    kwargs = {}
+    while True:
+        data = cw_cli.get_metric_data(
+            MetricDataQueries=queries,
+            StartTime=start_time,
+            EndTime=end_time,
+            **kwargs,
+        )
+        for page in data['MetricDataResults']:
+            result = results.setdefault(page['Id'], page)
+            if result is not page:
+                result['Timestamps'] += page['Timestamps']
+                result['Values'] += page['Values']
+                result['StatusCode'] = page['StatusCode']
+        next_token = data.get('NextToken')
+        if next_token is None:
+            return list(results.values())
+        kwargs = {'NextToken': next_token}
@@ -0,0 +1,57 @@
+import math
+import random
+from itertools import count, islice, takewhile
+from typing import Iterable, Iterator
+
+
+def constant(rate: float) -> Iterator[float]:
+    """Send times (seconds from the phase start) at a fixed rate"""
+    return (i / rate for i in count())
+
+
+def poisson(rate: float, seed: int | None = None) -> Iterator[float]:
+    """Send times of a Poisson process with an average rate of `rate`"""
+    rng = random.Random(seed)
+    t = 0.
+    while True:
+        yield t
+        t += rng.expovariate(rate)
+
+
+def ramp(start_rate: float, end_rate: float, duration: float) -> Iterator[float]:
+    """Rate going linearly from `start_rate` to `end_rate` in `duration`
+    seconds, then staying at `end_rate`"""
+    slope = (end_rate - start_rate) / duration
+    ramp_count = (start_rate + end_rate) * duration / 2
+    for i in count():
+        if i >= ramp_count:
+            if end_rate <= 0:
+                return
+            yield duration + (i - ramp_count) / end_rate
+        elif slope == 0:
+            yield i / start_rate
+        else:
+            # Solve start_rate * t + slope * t^2 / 2 = i
+            yield (math.sqrt(start_rate**2 + 2 * slope * i) - start_rate) / slope
+
+
+def steps(stages: list[tuple[float, float]]) -> Iterator[float]:
+    """Piecewise constant rate, `stages` being a list of (rate, duration).
+    The rate of the last stage is kept after its end."""
+    t0 = 0.
+    for i, (rate, duration) in enumerate(stages):
+        last = i == len(stages) - 1
+        for t in constant(rate):
+            if not last and t >= duration:
+                break
+            yield t0 + t
+        t0 += duration
+
+
+def limit(schedule: Iterable[float],
+          nb_requests: int | None = None,
+          duration: float | None = None) -> Iterator[float]:
+    """Stop a schedule after `nb_requests` requests and/or `duration` seconds"""
+    if duration is not None:
+        schedule = takewhile(lambda t: t < duration, schedule)
+    return islice(schedule, nb_requests)
@@ -0,0 +1,148 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import orjson
+
+from bench.config import CW_AGGREGATION_DELAY
+from bench.utils import to_timestamp
+
+if TYPE_CHECKING:
+    from mypy_boto3_cloudwatch.type_defs import (
+        MetricDataQueryTypeDef,
+        MetricDataResultTypeDef,
+    )
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (key, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    key TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coverage_key ON coverage (key, start);
+"""
+
+
+class MetricCache:
+    """On-disk cache of CloudWatch points, keyed by namespace, metric,
+    dimensions, statistic, unit and period.
+
+    The cache remembers which time ranges it holds for each key. Ranges
+    more recent than `CW_AGGREGATION_DELAY` are not remembered, as
+    CloudWatch may still update their points.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def missing(self,
+                query: 'MetricDataQueryTypeDef',
+                start_time: datetime,
+                end_time: datetime):
+        """Time ranges of [start_time, end_time) not in the cache"""
+        key, period = _key(query)
+        start, end = _align(start_time, end_time, period)
+        with self._lock:
+            covered = self._db.execute(
+                'SELECT start, end FROM coverage '
+                'WHERE key = ? AND end > ? AND start < ? ORDER BY start',
+                (key, start, end)).fetchall()
+        ranges = []
+        for cov_start, cov_end in covered:
+            if cov_start > start:
+                ranges.append((start, cov_start))
+            start = max(start, cov_end)
+        if start < end:
+            ranges.append((start, end))
+        return [(_to_datetime(a), _to_datetime(b)) for a, b in ranges]
+
+    def store(self,
+              query: 'MetricDataQueryTypeDef',
+              start_time: datetime,
+              end_time: datetime,
+              result: 'MetricDataResultTypeDef'):
+        """Save the points fetched for `query` in [start_time, end_time)"""
+        key, period = _key(query)
+        start, end = _align(start_time, end_time, period)
+        immutable = to_timestamp(
+            datetime.now(timezone.utc) - CW_AGGREGATION_DELAY)
+        rows = [(key, to_timestamp(t), v)
+                for t, v in zip(result['Timestamps'], result['Values'])]
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO points VALUES (?, ?, ?)', rows)
+            end = min(end, immutable - immutable % period)
+            if result['StatusCode'] == 'Complete' and start < end:
+                self._add_coverage(key, start, end)
+
+    def load(self,
+             query: 'MetricDataQueryTypeDef',
+             start_time: datetime,
+             end_time: datetime) -> 'MetricDataResultTypeDef':
+        """Cached points of `query`, in the format of `get_metric_data`"""
+        key, period = _key(query)
+        start, end = _align(start_time, end_time, period)
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT ts, value FROM points '
+                'WHERE key = ? AND ts >= ? AND ts < ? ORDER BY ts DESC',
+                (key, start, end)).fetchall()
+        return {
+            'Id': query['Id'],
+            'Label': query.get('Label', ''),
+            'Timestamps': [_to_datetime(ts) for ts, _ in rows],
+            'Values': [value for _, value in rows],
+            'StatusCode': 'Complete',
+            'Messages': [],
+        }
+
+    def _add_coverage(self, key: str, start: int, end: int):
+        # Merge with the overlapping or adjacent ranges
+        overlapping = self._db.execute(
+            'SELECT rowid, start, end FROM coverage '
+            'WHERE key = ? AND end >= ? AND start <= ?',
+            (key, start, end)).fetchall()
+        for rowid, cov_start, cov_end in overlapping:
+            start = min(start, cov_start)
+            end = max(end, cov_end)
+            self._db.execute('DELETE FROM coverage WHERE rowid = ?', (rowid,))
+        self._db.execute('INSERT INTO coverage VALUES (?, ?, ?)',
+                         (key, start, end))
+
+
+def _key(query: 'MetricDataQueryTypeDef'):
+    stat = query['MetricStat']
+    metric = stat['Metric']
+    dimensions = sorted((d['Name'], d['Value'])
+                        for d in metric.get('Dimensions', []))
+    key = orjson.dumps([
+        metric.get('Namespace'),
+        metric.get('MetricName'),
+        dimensions,
+        stat['Stat'],
+        stat.get('Unit'),
+        stat['Period'],
+    ]).decode()
+    return key, stat['Period']
+
+
+def _align(start_time: datetime, end_time: datetime, period: int):
+    """Round the range to whole periods, like CloudWatch does"""
+    start = to_timestamp(start_time)
+    end = to_timestamp(end_time)
+    return start - start % period, end + -end % period
+
+
+def _to_datetime(ts: int):
+    return datetime.fromtimestamp(ts, timezone.utc)
@@ -0,0 +1,267 @@
+import argparse
+import logging
+import sqlite3
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from statistics import NormalDist
+
+import numpy as np
+import orjson
+
+from bench.config import (
+    COMPARE_ALPHA,
+    COMPARE_INDEX_PATH,
+    COMPARE_MIN_CHANGE,
+    LOG_LEVEL,
+)
+from bench.histogram import LatencyHistogram
+from bench.store import ResultStore, open_store
+from bench.summary import CLUSTERS, METRICS, load_run
+
+logger = logging.getLogger(__name__)
+
+# Phase name of the CloudWatch metrics, which are not split by phase
+ALL_PHASES = '*'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    run TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    n REAL NOT NULL,
+    mean REAL NOT NULL,
+    var REAL NOT NULL,
+    histogram BLOB,
+    PRIMARY KEY (run, cluster, phase, metric)
+);
+"""
+
+
+@dataclass
+class Stat:
+    """Sample size, mean and variance of a metric, or latency histogram"""
+    n: float
+    mean: float
+    var: float
+    histogram: LatencyHistogram | None = None
+
+    def merge(self, other: 'Stat'):
+        n = self.n + other.n
+        mean = (self.n * self.mean + other.n * other.mean) / n if n else 0.
+        var = ((self.n - 1) * self.var + (other.n - 1) * other.var
+               + self.n * (self.mean - mean)**2
+               + other.n * (other.mean - mean)**2) / (n - 1) if n > 1 else 0.
+        histogram = self.histogram
+        if histogram is not None and other.histogram is not None:
+            histogram = LatencyHistogram().merge(histogram) \
+                .merge(other.histogram)
+        return Stat(n, mean, var, histogram)
+
+
+@dataclass
+class Comparison:
+    """Change of a metric, `z` is positive when the metric got worse"""
+    cluster: str
+    phase: str
+    metric: str
+    baseline: float
+    value: float
+    z: float
+    regression: bool
+
+
+class RunIndex:
+    """Statistics of every run of the result store, kept in SQLite and
+    only recomputed for the runs updated since they were indexed"""
+
+    def __init__(self, store: ResultStore, path: Path):
+        self.store = store
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def update(self):
+        indexed = dict(self._db.execute('SELECT run, updated FROM runs'))
+        for run, updated in self.store.runs().items():
+            if indexed.get(run) == updated:
+                continue
+            logger.info(f"Indexing {run}")
+            with self._db:
+                self._db.execute('DELETE FROM stats WHERE run = ?', (run,))
+                self._db.executemany(
+                    'INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(run, *row) for row in _run_stats(self.store, run)])
+                self._db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?)',
+                                 (run, updated))
+
+    def runs(self):
+        return [run for run, in self._db.execute(
+            'SELECT run FROM runs ORDER BY run')]
+
+    def stats(self, runs: list[str]):
+        """Statistics of `runs` merged by (cluster, phase, metric)"""
+        merged: dict[tuple[str, str, str], Stat] = {}
+        rows = self._db.execute(
+            'SELECT cluster, phase, metric, n, mean, var, histogram '
+            f"FROM stats WHERE run IN ({', '.join('?' * len(runs))})",
+            runs)
+        for cluster, phase, metric, n, mean, var, histogram in rows:
+            stat = Stat(n, mean, var, LatencyHistogram.from_dict(
+                orjson.loads(histogram)) if histogram is not None else None)
+            key = (cluster, phase, metric)
+            merged[key] = merged[key].merge(stat) if key in merged else stat
+        return merged
+
+
+def compare(baseline: dict[tuple[str, str, str], Stat],
+            candidate: dict[tuple[str, str, str], Stat],
+            alpha: float = COMPARE_ALPHA,
+            min_change: float = COMPARE_MIN_CHANGE):
+    """Compare the metrics found in both runs. A change is a regression when
+    it is significant at level `alpha` (one-sided) and larger than
+    `min_change` (relative)"""
+    critical = NormalDist().inv_cdf(1 - alpha)
+    comparisons = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        cluster, phase, metric = key
+        base, cand = baseline[key], candidate[key]
+        if base.n < 2 or cand.n < 2:
+            continue
+        if base.histogram is not None and cand.histogram is not None:
+            # Share of the requests slower than the baseline p99
+            base_value = base.histogram.percentiles([99.])[0]
+            value = cand.histogram.percentiles([99.])[0]
+            slower = cand.histogram.count_above(base_value) / cand.n
+            z = (slower - 0.01) / np.sqrt(0.01 * 0.99 / cand.n)
+            worse = value > base_value * (1 + min_change)
+        elif metric == 'error_rate':
+            # Two-proportion z-test
+            base_value, value = base.mean, cand.mean
+            pooled = (base.n * base_value + cand.n * value) \
+                / (base.n + cand.n)
+            se = np.sqrt(pooled * (1 - pooled) * (1 / base.n + 1 / cand.n))
+            z = (value - base_value) / se if se else 0.
+            worse = value > base_value * (1 + min_change)
+        else:
+            # Welch's test, normal approximation
+            base_value, value = base.mean, cand.mean
+            se = np.sqrt(base.var / base.n + cand.var / cand.n)
+            z = (value - base_value) / se if se else 0.
+            if metric == 'throughput':
+                z = -z
+                worse = value < base_value * (1 - min_change)
+            else:
+                worse = value > base_value * (1 + min_change)
+        comparisons.append(Comparison(
+            cluster, phase, metric, base_value, value, float(z),
+            bool(worse and z > critical)))
+    return comparisons
+
+
+def format_comparisons(comparisons: list[Comparison]):
+    lines = []
+    for c in comparisons:
+        change = f"{(c.value - c.baseline) / c.baseline * 100:+7.1f}%" \
+            if c.baseline else '-'.rjust(8)
+        flag = 'REGRESSION' if c.regression else ''
+        lines.append(f"{c.cluster:<10} {c.phase:<24} {c.metric:<12} "
+                     f"{c.baseline:>12.5g} -> {c.value:<12.5g} "
+                     f"{change}  z={c.z:+6.2f}  {flag}".rstrip())
+    return '\n'.join(lines)
+
+
+def _run_stats(store: ResultStore, run: str):
+    """Rows (cluster, phase, metric, n, mean, var, histogram) of a run"""
+    timestamps, series = load_run(store, run)
+    period = float(np.min(np.diff(timestamps)).astype('timedelta64[s]')
+                   .astype(float)) if len(timestamps) > 1 else 60.
+    requests_i = METRICS.index('RequestCount')
+    ok_i = METRICS.index('HTTPCode_Target_2XX_Count')
+    p99_i = METRICS.index('TargetResponseTime_p99')
+    for cluster, array in series.items():
+        throughput = array[requests_i] / period
+        yield cluster, ALL_PHASES, 'throughput', *_sample_stats(throughput)
+        yield cluster, ALL_PHASES, 'latency_p99', \
+            *_sample_stats(array[p99_i])
+        requests = np.nansum(array[requests_i])
+        if requests > 0 and not np.all(np.isnan(array[ok_i])):
+            rate = (requests - np.nansum(array[ok_i])) / requests
+            yield cluster, ALL_PHASES, 'error_rate', \
+                float(requests), float(rate), float(rate * (1 - rate)), None
+
+    clusters = {path: name for name, (_, path, _) in CLUSTERS.items()}
+    for path, phases in store.load_client(run).items():
+        cluster = clusters.get(path, path)
+        for phase, stats in phases.items():
+            requests = stats['requests']
+            if requests == 0:
+                continue
+            rate = stats['errors'] / requests
+            yield cluster, phase, 'error_rate', \
+                float(requests), rate, rate * (1 - rate), None
+            yield cluster, phase, 'latency_p99', float(requests), \
+                stats['p99'], 0., orjson.dumps(stats['histogram'])
+
+
+def _sample_stats(values: np.ndarray):
+    values = values[np.isfinite(values)]
+    var = float(values.var(ddof=1)) if len(values) > 1 else 0.
+    mean = float(values.mean()) if len(values) else 0.
+    return float(len(values)), mean, var, None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m bench.compare',
+        description='Compare a run with a baseline, exit with status 1 '
+                    'if a regression is found')
+    parser.add_argument('--results', type=Path, default=Path('results'),
+                        help='results directory (default: %(default)s)')
+    parser.add_argument('--run', help='run to check (default: the latest)')
+    baseline = parser.add_mutually_exclusive_group()
+    baseline.add_argument('--baseline', help='baseline run')
+    baseline.add_argument('--rolling', type=int, default=5, metavar='N',
+                          help='use the N runs before as baseline '
+                               '(default: %(default)s)')
+    parser.add_argument('--alpha', type=float, default=COMPARE_ALPHA,
+                        help='significance level (default: %(default)s)')
+    args = parser.parse_args()
+
+    index = RunIndex(open_store(args.results),
+                     args.results / COMPARE_INDEX_PATH)
+    index.update()
+    runs = index.runs()
+    run = args.run or (runs[-1] if runs else None)
+    if run not in runs:
+        parser.error(f"Run not found: {run}")
+    if args.baseline is not None:
+        if args.baseline not in runs:
+            parser.error(f"Run not found: {args.baseline}")
+        baseline_runs = [args.baseline]
+    else:
+        baseline_runs = runs[max(0, runs.index(run) - args.rolling):
+                             runs.index(run)]
+    if len(baseline_runs) == 0:
+        logger.warning(f"No baseline run before {run}")
+        return 0
+
+    logger.info(f"Comparing {run} with {', '.join(baseline_runs)}")
+    comparisons = compare(index.stats(baseline_runs), index.stats([run]),
+                          alpha=args.alpha)
+    print(format_comparisons(comparisons))
+    regressions = [c for c in comparisons if c.regression]
+    if regressions:
+        logger.error(f"{len(regressions)} regression(s) found")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL)
+    sys.exit(main())
@@ -1,3 +1,6 @@
+import os
+from datetime import timedelta
+
 LOG_LEVEL = 'INFO'
 
 LB_NAME = 'Lab1'
@@ -5,61 +8,163 @@ CLUSTER_1_PATH = '/cluster1'
 CLUSTER_1_TARGET_NAME = f"{LB_NAME}-1"
 CLUSTER_2_PATH = '/cluster2'
 CLUSTER_2_TARGET_NAME = f"{LB_NAME}-2"
+CLUSTER_1_INSTANCE_TYPE = 'm4.large'
+CLUSTER_2_INSTANCE_TYPE = 't2.large'
+# Wait for the targets of both clusters to be healthy before the bench:
+# overall timeout (s) and longest delay between two polls (s)
+TARGETS_READY_TIMEOUT = 600
+TARGETS_READY_MAX_DELAY = 10
+# Resamples of the bootstrap confidence intervals of the cluster comparison
+BOOTSTRAP_RESAMPLES = 10000
+# CloudWatch and client-side results of every run, in the results directory
+RESULTS_STORE = 'results.sqlite'
+# Cross-run comparison (python -m bench.compare): significance level and
+# smallest relative change reported as a regression
+COMPARE_ALPHA = 0.01
+COMPARE_MIN_CHANGE = 0.05
+# Index of the runs, relative to the results directory
+COMPARE_INDEX_PATH = '.cache/index.sqlite'
+
+# Virtual users per scenario, they all share one connection pool. The
+# defaults reproduce the original client: one sequential user per scenario
+# opening a new connection for every request.
+CONCURRENCY = int(os.environ.get('BENCH_CONCURRENCY', '1'))
+# Set BENCH_KEEP_ALIVE=1 to reuse the connections of the pool
+KEEP_ALIVE = os.environ.get('BENCH_KEEP_ALIVE', '0') == '1'
+
+# Worker processes sharing the virtual users and request rates
+WORKERS = int(os.environ.get('BENCH_WORKERS', '1'))
+
+# 'closed' waits for each response before sending the next request,
+# 'constant' and 'poisson' send BENCH_RATE requests per second (open loop)
+ARRIVAL = os.environ.get('BENCH_ARRIVAL', 'closed')
+RATE = float(os.environ.get('BENCH_RATE', '50'))
+# Open loop: requests above this limit are dropped instead of queued
+MAX_IN_FLIGHT = int(os.environ.get('BENCH_MAX_IN_FLIGHT', '200'))
+# Open loop: requests sent later than planned by more than this (s) are late
+LATE_THRESHOLD = 0.01
+
+# Set BENCH_REQUEST_LOG=0 to not save every request in results/<ts>/requests
+REQUEST_LOG = os.environ.get('BENCH_REQUEST_LOG', '1') == '1'
+# Requests buffered in memory before being written to the request log
+REQUEST_LOG_BATCH = 8192
+
+# Set BENCH_SCRAPE=0 to not scrape the /metrics endpoint of the app instances
+SCRAPE = os.environ.get('BENCH_SCRAPE', '1') == '1'
+SCRAPE_INTERVAL = 5
+SCRAPE_TIMEOUT = 2
 
+# Local stand-in of the load balancer (python -m bench.localalb)
+LOCAL_LB_ADDRESS = '127.0.0.1:8080'
+LOCAL_TARGETS_PER_GROUP = 2
+# Health checks, thresholds are the ALB defaults
+LOCAL_HEALTH_INTERVAL = 2
+LOCAL_HEALTHY_THRESHOLD = 5
+LOCAL_UNHEALTHY_THRESHOLD = 2
+
+# CloudWatch queries: at most this many points per series (see _choose_period)
+CW_MAX_POINTS = 1440
+CW_MAX_QUERIES_PER_CALL = 500
+CW_MAX_WORKERS = 4
+# Local cache of CloudWatch points, set BENCH_CW_CACHE=0 to disable it
+CW_CACHE = os.environ.get('BENCH_CW_CACHE', '1') == '1'
+CW_CACHE_PATH = 'results/.cache/metrics.sqlite'
+# Points older than this are considered final
+CW_AGGREGATION_DELAY = timedelta(minutes=15)
+
+# Metrics fetched from CloudWatch and graphed, 'METRIC' defaults to the key
 GRAPH_INFO = {
     'ActiveConnectionCount': {
         'TITLE': 'Active Connection Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of active TCP Connection per times'
+        'YLABEL': '# of active TCP Connection per times',
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'ConsumedLCUs': {
         'TITLE': 'Consumed LCUs',
         'XLABEL': 'Timestamps',
-        'YLABEL': 'Price (USD)'
+        'YLABEL': 'Price (USD)',
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'HTTP_Redirect_Count': {
         'TITLE': 'HTTP Redirect Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of redirect actions that were successful'
+        'YLABEL': '# of redirect actions that were successful',
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'RuleEvaluations': {
         'TITLE': 'Rule Evaluations',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of rules processed'
+        'YLABEL': '# of rules processed',
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'RequestCount': {
         'TITLE': 'Request Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of requests processed'
+        'YLABEL': '# of requests processed',
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'ProcessedBytes': {
         'TITLE': 'Processed Bytes',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of bytes processed by loadbalancer (Bytes)'
+        'YLABEL': '# of bytes processed by loadbalancer (Bytes)',
+        'STAT': 'Sum',
+        'UNIT': 'Bytes'
     },
     'HTTPCode_Target_2XX_Count': {
         'TITLE': 'HTTP Code Target 2XX Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# HTTP response by targets'
+        'YLABEL': '# HTTP response by targets',
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'HealthyHostCount': {
         'TITLE': 'Healthy Host Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of targets that are considered healthy'
+        'YLABEL': '# of targets that are considered healthy',
+        'STAT': 'Average',
+        'UNIT': 'Count'
     },
     'TargetConnectionErrorCount': {
         'TITLE': 'Target Connection Error Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of connections that were not successfully established between the loadBalancer and target'  # noqa
+        'YLABEL': '# of connections that were not successfully established between the loadBalancer and target',  # noqa
+        'STAT': 'Sum',
+        'UNIT': 'Count'
     },
     'TargetResponseTime': {
         'TITLE': 'Target Response Time',
         'XLABEL': 'Timestamps',
-        'YLABEL': 'Time elapsed (Second) after the request leaves the loadBalancer until a response from the target is received'  # noqa
+        'YLABEL': 'Time elapsed (Second) after the request leaves the loadBalancer until a response from the target is received',  # noqa
+        'STAT': 'Average',
+        'UNIT': 'Seconds'
+    },
+    'TargetResponseTime_p50': {
+        'TITLE': 'Target Response Time (p50)',
+        'XLABEL': 'Timestamps',
+        'YLABEL': 'Median time elapsed (Second) after the request leaves the loadBalancer until a response from the target is received',  # noqa
+        'METRIC': 'TargetResponseTime',
+        'STAT': 'p50',
+        'UNIT': 'Seconds'
+    },
+    'TargetResponseTime_p99': {
+        'TITLE': 'Target Response Time (p99)',
+        'XLABEL': 'Timestamps',
+        'YLABEL': '99th percentile of the time elapsed (Second) after the request leaves the loadBalancer until a response from the target is received',  # noqa
+        'METRIC': 'TargetResponseTime',
+        'STAT': 'p99',
+        'UNIT': 'Seconds'
     },
     'UnHealthyHostCount': {
         'TITLE': 'Unhealthy Host Count',
         'XLABEL': 'Timestamps',
-        'YLABEL': '# of targets that are considered unhealthy'
+        'YLABEL': '# of targets that are considered unhealthy',
+        'STAT': 'Average',
+        'UNIT': 'Count'
     }
 }
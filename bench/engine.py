@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import math
+import re
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Iterable
+
+import aiohttp
+
+from bench.config import LATE_THRESHOLD
+from bench.histogram import LatencyHistogram
+from bench.reqlog import RequestLog
+
+logger = logging.getLogger(__name__)
+
+# Duration (ms) of the app in the Server-Timing header of the responses
+SERVER_TIMING_RE = re.compile(r'(?:^|,)\s*app;dur=([0-9.]+)')
+
+
+@dataclass
+class PhaseStats:
+    requests: int = 0
+    errors: int = 0
+    # Open loop only: requests sent after their planned time,
+    # or not sent at all because too many requests were in flight
+    late: int = 0
+    dropped: int = 0
+    latencies: LatencyHistogram = field(default_factory=LatencyHistogram)
+    # Breakdown of the latencies of the responses with a Server-Timing
+    # header: time before the request was sent (client), time spent by the
+    # app and the rest (network and load balancer)
+    client_times: LatencyHistogram = field(default_factory=LatencyHistogram)
+    network_times: LatencyHistogram = field(default_factory=LatencyHistogram)
+    app_times: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    def record(self,
+               latency: float,
+               ok: bool,
+               client_time: float = 0.,
+               app_time: float = math.nan):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.latencies.record(latency)
+        if not math.isnan(app_time):
+            self.client_times.record(client_time)
+            self.app_times.record(app_time)
+            self.network_times.record(
+                max(0., latency - client_time - app_time))
+
+    def merge(self, other: 'PhaseStats'):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.late += other.late
+        self.dropped += other.dropped
+        self.latencies.merge(other.latencies)
+        self.client_times.merge(other.client_times)
+        self.network_times.merge(other.network_times)
+        self.app_times.merge(other.app_times)
+        return self
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'late': self.late,
+            'dropped': self.dropped,
+            **self.latencies.summary(),
+        }
+
+    def breakdown(self):
+        return {
+            'client': self.client_times,
+            'network': self.network_times,
+            'app': self.app_times,
+        }
+
+    def to_dict(self):
+        return {
+            **self.summary(),
+            'histogram': self.latencies.to_dict(),
+            'breakdown': {name: histogram.to_dict()
+                          for name, histogram in self.breakdown().items()},
+        }
+
+
+def make_session(concurrency: int, keep_alive: bool):
+    """Create a client session backed by a pool shared by all virtual users"""
+    connector = aiohttp.TCPConnector(limit=concurrency,
+                                     force_close=not keep_alive)
+    return aiohttp.ClientSession(connector=connector,
+                                 trace_configs=[_queue_trace_config()])
+
+
+def _queue_trace_config():
+    """Add the time spent waiting for a connection of the pool to the
+    `queued` entry of the `trace_request_ctx` dict of a request"""
+    async def on_queued_start(session, context, params):
+        context.queued_start = asyncio.get_running_loop().time()
+
+    async def on_queued_end(session, context, params):
+        context.trace_request_ctx['queued'] += \
+            asyncio.get_running_loop().time() - context.queued_start
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_queued_start.append(on_queued_start)
+    trace_config.on_connection_queued_end.append(on_queued_end)
+    return trace_config
+
+
+async def run_closed_loop(session: aiohttp.ClientSession,
+                          url: str,
+                          concurrency: int,
+                          nb_requests: int | None = None,
+                          duration: float | None = None,
+                          log: RequestLog | None = None):
+    """Send requests to `url` from `concurrency` virtual users until
+    `nb_requests` requests are sent and/or `duration` seconds are elapsed.
+
+    Each virtual user waits for its response before sending the next request.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration if duration is not None else None
+    requests_left = iter(range(nb_requests)) if nb_requests is not None \
+        else count()
+    stats = PhaseStats()
+
+    async def virtual_user():
+        for _ in requests_left:
+            if deadline is not None and loop.time() >= deadline:
+                break
+            await _make_req(session, url, loop.time(), stats, log)
+
+    if nb_requests is not None:
+        concurrency = min(concurrency, nb_requests)
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(concurrency):
+            tg.create_task(virtual_user())
+    return stats
+
+
+async def run_open_loop(session: aiohttp.ClientSession,
+                        url: str,
+                        schedule: Iterable[float],
+                        max_in_flight: int,
+                        late_threshold: float = LATE_THRESHOLD,
+                        log: RequestLog | None = None):
+    """Send requests to `url` at the times given by `schedule` (in seconds
+    from now), whether or not previous requests have completed.
+
+    Latencies are measured from the planned send time so that a slow target
+    cannot hide its delays by slowing the client down (coordinated omission).
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    stats = PhaseStats()
+    in_flight: set[asyncio.Task] = set()
+
+    async with asyncio.TaskGroup() as tg:
+        for offset in schedule:
+            planned = start + offset
+            delay = planned - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif -delay > late_threshold:
+                stats.late += 1
+            if len(in_flight) >= max_in_flight:
+                stats.dropped += 1
+                continue
+            task = tg.create_task(
+                _make_req(session, url, planned, stats, log))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+    return stats
+
+
+async def _make_req(session: aiohttp.ClientSession,
+                    url: str,
+                    start: float,
+                    stats: PhaseStats,
+                    log: RequestLog | None):
+    loop = asyncio.get_running_loop()
+    status = 0
+    body = b''
+    app_time = math.nan
+    instance = None
+    # Client time: scheduling delay and wait for a connection of the pool
+    trace = {'queued': loop.time() - start}
+    try:
+        async with session.get(url, trace_request_ctx=trace) as resp:
+            body = await resp.read()
+            status = resp.status
+            timing = SERVER_TIMING_RE.search(
+                resp.headers.get('Server-Timing', ''))
+            if timing is not None:
+                app_time = float(timing.group(1)) / 1000
+            instance = resp.headers.get('X-Instance-Id')
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f"Request to {url} failed: {e!r}")
+    latency = loop.time() - start
+    client_time = trace['queued']
+    stats.record(latency, 0 < status < 400, client_time, app_time)
+    if log is not None:
+        log.record(url, start, latency, status, body,
+                   client_time, app_time, instance)
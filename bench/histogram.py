@@ -0,0 +1,99 @@
+import numpy as np
+
+# Values are recorded as integer microseconds in log-linear buckets
+# (HDR histogram layout): values below 2^SUB_BUCKET_BITS get one bucket each,
+# then every power of two is split in 2^(SUB_BUCKET_BITS - 1) buckets.
+# This keeps the relative error under 1% up to MAX_VALUE_BITS (~19 hours).
+SUB_BUCKET_BITS = 8
+MAX_VALUE_BITS = 36
+_SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+_SUB_BUCKET_HALF = _SUB_BUCKET_COUNT >> 1
+_BUCKET_COUNT = (_SUB_BUCKET_COUNT
+                 + (MAX_VALUE_BITS - SUB_BUCKET_BITS) * _SUB_BUCKET_HALF)
+_MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+
+PERCENTILES = (50., 90., 99., 99.9)
+
+
+def _index(value: int):
+    if value < _SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return _SUB_BUCKET_COUNT + (shift - 1) * _SUB_BUCKET_HALF \
+        + (value >> shift) - _SUB_BUCKET_HALF
+
+
+def _upper_bounds():
+    """Highest value (µs) falling in each bucket"""
+    indices = np.arange(_BUCKET_COUNT, dtype=np.int64)
+    shifts = np.maximum(indices - _SUB_BUCKET_COUNT, -1) // _SUB_BUCKET_HALF + 1
+    mantissas = np.where(
+        indices < _SUB_BUCKET_COUNT,
+        indices,
+        (indices - _SUB_BUCKET_COUNT) % _SUB_BUCKET_HALF + _SUB_BUCKET_HALF)
+    return ((mantissas + 1) << shifts) - 1
+
+
+_UPPER_BOUNDS = _upper_bounds()
+
+
+class LatencyHistogram:
+    """Fixed-size latency histogram that can be merged with other ones"""
+
+    def __init__(self, counts: np.ndarray | None = None, max_value: int = 0):
+        self.counts = counts if counts is not None \
+            else np.zeros(_BUCKET_COUNT, dtype=np.int64)
+        self.max_value = max_value
+
+    def record(self, latency: float):
+        """Record a latency in seconds"""
+        value = min(int(latency * 1e6), _MAX_VALUE)
+        self.counts[_index(value)] += 1
+        if value > self.max_value:
+            self.max_value = value
+
+    def merge(self, other: 'LatencyHistogram'):
+        self.counts += other.counts
+        self.max_value = max(self.max_value, other.max_value)
+        return self
+
+    def count_above(self, latency: float):
+        """Number of values recorded in buckets above `latency` (seconds)"""
+        value = min(int(latency * 1e6), _MAX_VALUE)
+        return int(self.counts[_index(value) + 1:].sum())
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """Latencies in seconds at the given percentiles"""
+        cumsum = np.cumsum(self.counts)
+        if cumsum[-1] == 0:
+            return [0.] * len(percentiles)
+        ranks = np.ceil(np.asarray(percentiles) / 100 * cumsum[-1])
+        indices = np.searchsorted(cumsum, np.maximum(ranks, 1))
+        values = np.minimum(_UPPER_BOUNDS[indices], self.max_value)
+        return (values / 1e6).tolist()
+
+    def summary(self):
+        summary = {
+            f"p{p:g}": v for p, v in zip(PERCENTILES, self.percentiles())
+        }
+        summary['max'] = self.max_value / 1e6
+        return summary
+
+    def to_dict(self):
+        """Sparse representation of the non-empty buckets"""
+        indices = np.flatnonzero(self.counts)
+        return {
+            'indices': indices.tolist(),
+            'counts': self.counts[indices].tolist(),
+            'max_value': self.max_value,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        counts = np.zeros(_BUCKET_COUNT, dtype=np.int64)
+        counts[data['indices']] = data['counts']
+        return cls(counts, data['max_value'])
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+from collections import defaultdict
+from datetime import datetime
+from fnmatch import fnmatchcase
+from itertools import count
+from pathlib import Path
+from time import monotonic
+
+import aiohttp
+from aiohttp import web
+
+from bench.config import (
+    LOCAL_HEALTH_INTERVAL,
+    LOCAL_HEALTHY_THRESHOLD,
+    LOCAL_LB_ADDRESS,
+    LOCAL_TARGETS_PER_GROUP,
+    LOCAL_UNHEALTHY_THRESHOLD,
+    LOG_LEVEL,
+)
+from deploy.config import HEALTH_CHECK_PATH, LISTENER_RULES
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = '/_localalb/metrics'
+TARGETS_PATH = '/_localalb/targets'
+ALGORITHMS = ('round_robin', 'least_outstanding_requests')
+
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'host',
+}
+# CloudWatch statistic of each metric, the others are sums
+AVERAGE_METRICS = {'TargetResponseTime', 'HealthyHostCount',
+                   'UnHealthyHostCount'}
+
+
+class Target:
+    def __init__(self, id: str, address: str):
+        self.id = id
+        self.address = address
+        self.healthy = False
+        self.outstanding = 0
+        self._streak = 0
+
+    def report_health(self, ok: bool):
+        """Update the state after a health check, like an ALB target group
+        does with its healthy/unhealthy threshold counts"""
+        if ok != self.healthy:
+            self._streak += 1
+            threshold = LOCAL_HEALTHY_THRESHOLD if ok \
+                else LOCAL_UNHEALTHY_THRESHOLD
+            if self._streak >= threshold:
+                self.healthy = ok
+                self._streak = 0
+                logger.info(f"Target {self.id} is now "
+                            f"{'healthy' if ok else 'unhealthy'}")
+        else:
+            self._streak = 0
+
+
+class TargetGroup:
+    def __init__(self, name: str, targets: list[Target], algorithm: str):
+        self.name = name
+        self.targets = targets
+        self.algorithm = algorithm
+        self._next = count()
+
+    def pick(self):
+        # Like an ALB, fail open when no target is healthy
+        targets = [t for t in self.targets if t.healthy] or self.targets
+        if self.algorithm == 'least_outstanding_requests':
+            return min(targets, key=lambda t: t.outstanding)
+        return targets[next(self._next) % len(targets)]
+
+
+class Metrics:
+    """Per-minute metrics of the load balancer or of a target group"""
+
+    def __init__(self):
+        self._sums: dict[str, dict[datetime, float]] = defaultdict(
+            lambda: defaultdict(float))
+        self._samples: dict[str, dict[datetime, int]] = defaultdict(
+            lambda: defaultdict(int))
+        self._connections: dict[datetime, set[int]] = defaultdict(set)
+
+    def add(self, metric: str, value: float = 1.):
+        minute = _current_minute()
+        self._sums[metric][minute] += value
+        self._samples[metric][minute] += 1
+
+    def add_connection(self, connection_id: int):
+        self._connections[_current_minute()].add(connection_id)
+
+    def results(self, start: datetime | None, end: datetime | None):
+        """Metrics between `start` and `end`, in the format of
+        `MetricDataResults`, newest timestamps first"""
+        if start is not None:
+            start = start.replace(second=0, microsecond=0)
+        series = dict(self._sums)
+        if self._connections:
+            series['ActiveConnectionCount'] = {
+                minute: float(len(ids))
+                for minute, ids in self._connections.items()}
+        results = []
+        for metric, values in series.items():
+            minutes = sorted(
+                (m for m in values
+                 if (start is None or m >= start)
+                 and (end is None or m <= end)),
+                reverse=True)
+            if metric in AVERAGE_METRICS:
+                samples = self._samples[metric]
+                points = [values[m] / samples[m] for m in minutes]
+            else:
+                points = [values[m] for m in minutes]
+            results.append({
+                'Id': f"local_{metric}",
+                'Label': metric,
+                'Timestamps': [m.isoformat() for m in minutes],
+                'Values': points,
+                'StatusCode': 'Complete',
+            })
+        return results
+
+
+class LocalLoadBalancer:
+    def __init__(self, groups: dict[str, TargetGroup]):
+        self.groups = groups
+        self.metrics = Metrics()
+        self.group_metrics = {name: Metrics() for name in groups}
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self, app: web.Application):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0),
+            auto_decompress=False)
+        app['health_checks'] = asyncio.create_task(self._health_checks())
+
+    async def stop(self, app: web.Application):
+        app['health_checks'].cancel()
+        if self._session is not None:
+            await self._session.close()
+
+    async def handle(self, request: web.Request):
+        if request.path == METRICS_PATH:
+            return self._handle_metrics(request)
+        if request.path == TARGETS_PATH:
+            return web.json_response({
+                target.id: target.address
+                for tg in self.groups.values() for target in tg.targets})
+
+        self.metrics.add('RequestCount')
+        self.metrics.add_connection(id(request.transport))
+        tg_name = None
+        for _, path_patterns, name in LISTENER_RULES:
+            self.metrics.add('RuleEvaluations')
+            if any(fnmatchcase(request.path, p) for p in path_patterns):
+                tg_name = name
+                break
+        if tg_name is None:
+            return web.Response(status=404)
+        return await self._forward(request, self.groups[tg_name])
+
+    async def _forward(self, request: web.Request, tg: TargetGroup):
+        assert self._session is not None
+        tg_metrics = self.group_metrics[tg.name]
+        tg_metrics.add('RequestCount')
+        target = tg.pick()
+        headers = _filter_headers(request.headers)
+        if request.remote is not None:
+            headers['X-Forwarded-For'] = request.remote
+        body = await request.read()
+        processed = len(body)
+
+        target.outstanding += 1
+        start = monotonic()
+        try:
+            try:
+                upstream = await self._session.request(
+                    request.method,
+                    f"http://{target.address}{request.rel_url}",
+                    headers=headers,
+                    data=body,
+                    allow_redirects=False)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.debug(f"Connection to {target.id} failed: {e!r}")
+                for m in (self.metrics, tg_metrics):
+                    m.add('TargetConnectionErrorCount')
+                return web.Response(status=502)
+            async with upstream:
+                for m in (self.metrics, tg_metrics):
+                    m.add('TargetResponseTime', monotonic() - start)
+                    if 200 <= upstream.status < 300:
+                        m.add('HTTPCode_Target_2XX_Count')
+                response = web.StreamResponse(
+                    status=upstream.status,
+                    headers=_filter_headers(upstream.headers))
+                await response.prepare(request)
+                async for chunk in upstream.content.iter_any():
+                    processed += len(chunk)
+                    await response.write(chunk)
+                await response.write_eof()
+                return response
+        finally:
+            target.outstanding -= 1
+            for m in (self.metrics, tg_metrics):
+                m.add('ProcessedBytes', processed)
+
+    def _handle_metrics(self, request: web.Request):
+        tg_name = request.query.get('target_group')
+        metrics = self.metrics if tg_name is None \
+            else self.group_metrics.get(tg_name)
+        if metrics is None:
+            raise web.HTTPNotFound(text=f"Unknown target group {tg_name}")
+        start = request.query.get('start')
+        end = request.query.get('end')
+        return web.json_response(metrics.results(
+            datetime.fromisoformat(start) if start else None,
+            datetime.fromisoformat(end) if end else None))
+
+    async def _health_checks(self):
+        assert self._session is not None
+        timeout = aiohttp.ClientTimeout(total=LOCAL_HEALTH_INTERVAL)
+        while True:
+            checks = [
+                self._health_check(target, timeout)
+                for tg in self.groups.values() for target in tg.targets
+            ]
+            await asyncio.gather(*checks, asyncio.sleep(LOCAL_HEALTH_INTERVAL))
+            for tg in self.groups.values():
+                healthy = sum(t.healthy for t in tg.targets)
+                metrics = self.group_metrics[tg.name]
+                metrics.add('HealthyHostCount', healthy)
+                metrics.add('UnHealthyHostCount', len(tg.targets) - healthy)
+
+    async def _health_check(self, target: Target, timeout: aiohttp.ClientTimeout):
+        assert self._session is not None
+        try:
+            async with self._session.get(
+                    f"http://{target.address}{HEALTH_CHECK_PATH}",
+                    timeout=timeout) as resp:
+                ok = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        target.report_health(ok)
+
+
+async def serve(address: str, targets_per_group: int, algorithm: str):
+    host, port = address.rsplit(':', 1)
+    processes: list[asyncio.subprocess.Process] = []
+    groups: dict[str, TargetGroup] = {}
+    target_port = int(port) + 1
+    for _, path_patterns, tg_name in LISTENER_RULES:
+        targets = []
+        for i in range(targets_per_group):
+            target = Target(f"local-{tg_name}-{i}",
+                            f"127.0.0.1:{target_port}")
+            processes.append(await _start_app(target, path_patterns[0]))
+            targets.append(target)
+            target_port += 1
+        groups[tg_name] = TargetGroup(tg_name, targets, algorithm)
+
+    lb = LocalLoadBalancer(groups)
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', lb.handle)
+    app.on_startup.append(lb.start)
+    app.on_cleanup.append(lb.stop)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, int(port)).start()
+        logger.info(f"Local load balancer listening on {address}")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            await p.wait()
+
+
+async def _start_app(target: Target, route_rule: str):
+    logger.info(f"Starting {target.id} on {target.address}")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'gunicorn', '-c', 'python:app.gunicorn_conf',
+        '-b', target.address, 'app:app',
+        cwd=Path(__file__).parent.parent,
+        # All the targets share this machine: one worker each by default
+        env={'APP_WORKERS': '1',
+             **os.environ,
+             'INSTANCE_ID': target.id,
+             'ROUTE_RULE': route_rule})
+
+
+def _filter_headers(headers):
+    return {k: v for k, v in headers.items()
+            if k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+def _current_minute():
+    return datetime.utcnow().replace(second=0, microsecond=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m bench.localalb')
+    parser.add_argument('--address', default=LOCAL_LB_ADDRESS,
+                        help='listening address (default: %(default)s)')
+    parser.add_argument('-n', '--targets-per-group', type=int,
+                        default=LOCAL_TARGETS_PER_GROUP,
+                        help='app processes per target group '
+                             '(default: %(default)s)')
+    parser.add_argument('-a', '--algorithm', choices=ALGORITHMS,
+                        default='round_robin',
+                        help='load balancing algorithm (default: %(default)s)')
+    args = parser.parse_args()
+    asyncio.run(serve(args.address, args.targets_per_group, args.algorithm))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL)
+    main()
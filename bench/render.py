@@ -0,0 +1,58 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+matplotlib.use('Agg')
+
+
+@dataclass
+class BarGraph:
+    path: Path
+    xlabel: str
+    ylabel: str
+    abscissa: list[str]
+    ordinate: list[float]
+
+
+# Figure reused by all the graphs rendered in a process
+_figure: Figure | None = None
+
+
+def render_graphs(graphs: list[BarGraph], workers: int | None = None):
+    """Render the graphs in a pool of processes"""
+    if len(graphs) == 0:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(graphs))
+    if workers == 1:
+        for graph in graphs:
+            render_graph(graph)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = -(-len(graphs) // workers)
+        for _ in executor.map(render_graph, graphs, chunksize=chunksize):
+            pass
+
+
+def render_graph(graph: BarGraph):
+    global _figure
+    if _figure is None:
+        _figure = Figure(figsize=(10, 10))
+        FigureCanvasAgg(_figure)
+    fig = _figure
+    fig.clear()
+    ax = fig.add_subplot(111)
+    x_axis = np.arange(len(graph.abscissa))
+    bars = ax.bar(x_axis, graph.ordinate)
+    ax.set_xticks(x_axis, graph.abscissa, rotation=45)
+    # Value labels of all the bars in one pass
+    ax.bar_label(bars, labels=[str(y) for y in graph.ordinate])
+    ax.set_xlabel(graph.xlabel)
+    ax.set_ylabel(graph.ylabel)
+    ax.plot(x_axis, graph.ordinate, color="red")
+    fig.savefig(graph.path)
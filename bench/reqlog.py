@@ -0,0 +1,122 @@
+import math
+import re
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+import orjson
+
+from bench.config import REQUEST_LOG_BATCH
+
+# One fixed-width record per request
+RECORD_DTYPE = np.dtype([
+    ('send_time', '<f8'),  # planned send time (Unix timestamp)
+    ('latency', '<f4'),  # seconds
+    ('status', '<u2'),  # 0 when no response was received
+    ('bytes', '<u4'),  # response body size
+    ('path', '<u2'),  # index in the paths table of the log
+    ('instance', 'S19'),  # responding EC2 instance ID
+    ('worker', '<u2'),
+    ('client_time', '<f4'),  # seconds between planned and actual send times
+    ('app_time', '<f4'),  # Server-Timing of the app, NaN if missing
+])
+
+INSTANCE_ID_RE = re.compile(rb'Instance ID (\S+) is responding now!')
+# Responses without an X-Instance-Id header: bytes of the body searched for
+# the instance ID, which starts the hello response, so that large payloads
+# are not scanned
+INSTANCE_ID_SCAN = 256
+
+
+class RequestLog:
+    """Append-only log of requests, written to disk in batches.
+
+    Records are kept in a list of tuples until `REQUEST_LOG_BATCH` of them
+    are buffered, so memory stays bounded whatever the length of the run.
+    """
+
+    def __init__(self, path: Path, worker: int = 0):
+        self.path = path
+        self.worker = worker
+        # Send times are measured with the event loop's monotonic clock
+        self.clock_offset = time.time() - time.monotonic()
+        self._urls: dict[str, int] = {}
+        self._batch: list[tuple] = []
+        self._count = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, 'wb')
+
+    def record(self,
+               url: str,
+               send_time: float,
+               latency: float,
+               status: int,
+               body: bytes,
+               client_time: float = 0.,
+               app_time: float = math.nan,
+               instance: str | None = None):
+        path_id = self._urls.setdefault(url, len(self._urls))
+        if instance is None:
+            match = INSTANCE_ID_RE.search(body, 0, INSTANCE_ID_SCAN)
+            instance_id = match.group(1) if match is not None else b''
+        else:
+            instance_id = instance.encode()
+        self._batch.append((
+            send_time + self.clock_offset,
+            latency,
+            status,
+            len(body),
+            path_id,
+            instance_id,
+            self.worker,
+            client_time,
+            app_time,
+        ))
+        if len(self._batch) >= REQUEST_LOG_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._file.write(np.array(self._batch, RECORD_DTYPE).tobytes())
+            self._count += len(self._batch)
+            self._batch.clear()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self.path.with_suffix('.json').write_bytes(orjson.dumps({
+            'paths': [_target_path(url) for url in self._urls],
+            'count': self._count,
+            'dtype': RECORD_DTYPE.descr,
+        }))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _target_path(url: str):
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def load_request_log(path: Path):
+    """Map a request log in memory, return its records and paths table.
+    Columns (e.g. `records['latency']`) are views on the file."""
+    meta = orjson.loads(path.with_suffix('.json').read_bytes())
+    # Logs written before the dtype was saved have the first 7 columns
+    dtype = np.dtype([tuple(column) for column in meta['dtype']]) \
+        if 'dtype' in meta else np.dtype(RECORD_DTYPE.descr[:7])
+    if path.stat().st_size == 0:
+        records = np.empty(0, dtype)
+    else:
+        records = np.memmap(path, dtype=dtype, mode='r')
+    return records, meta['paths']
+
+
+def load_request_logs(directory: Path):
+    return {path.stem: load_request_log(path)
+            for path in sorted(directory.glob('*.bin'))}
@@ -1,42 +1,87 @@
+import asyncio
 import logging
-from threading import Barrier, Thread
-from time import sleep
+from typing import Any, Mapping, Protocol
 
-import requests
+import aiohttp
+
+from bench.engine import PhaseStats, make_session, run_closed_loop, run_open_loop
+from bench.reqlog import RequestLog
+from bench.workload import Phase, Scenario, Workload
 
 logger = logging.getLogger(__name__)
 
-barrier = Barrier(2)
+
+class Barrier(Protocol):
+    async def wait(self) -> Any: ...
 
 
-def run_scenarios(lb_dns: str, path: str):
-    barrier.reset()
-    thread1 = Thread(target=scenario1, args=(lb_dns, path))
-    thread2 = Thread(target=scenario2, args=(lb_dns, path))
-    thread1.start()
-    thread2.start()
-    thread1.join()
-    thread2.join()
+def run_scenarios(lb_dns: str,
+                  path: str,
+                  workload: Workload,
+                  log: RequestLog | None = None):
+    """Run all the scenarios of `workload` on `path`,
+    return the statistics of each phase"""
+    barriers = {name: asyncio.Barrier(parties)
+                for name, parties in workload.barrier_parties().items()}
+    return asyncio.run(
+        run_scenarios_async(lb_dns, path, workload, barriers, log))
 
 
-def scenario1(lb_dns: str, path: str):
-    logger.info(f"Starting scenario 1 on {path}")
-    barrier.wait()
-    for _ in range(1000):
-        _make_req(lb_dns, path)
-    logger.info(f"Finished scenario 1 on {path}")
+async def run_scenarios_async(lb_dns: str,
+                              path: str,
+                              workload: Workload,
+                              barriers: Mapping[str, Barrier],
+                              log: RequestLog | None = None):
+    url = f"http://{lb_dns}{path}"
+    # All scenarios share the same pool, sized for all their virtual users
+    async with make_session(workload.pool_size, workload.keep_alive) as session:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(
+                    run_scenario(session, url, scenario, barriers, log))
+                for scenario in workload.scenarios
+            ]
+    stats: dict[str, PhaseStats] = {}
+    for task in tasks:
+        stats |= task.result()
+    return stats
 
 
-def scenario2(lb_dns: str, path: str):
-    logger.info(f"Starting scenario 2 on {path}")
-    barrier.wait()
-    for _ in range(500):
-        _make_req(lb_dns, path)
-    sleep(60)
-    for _ in range(1000):
-        _make_req(lb_dns, path)
-    logger.info(f"Finished scenario 2 on {path}")
+async def run_scenario(session: aiohttp.ClientSession,
+                       url: str,
+                       scenario: Scenario,
+                       barriers: Mapping[str, Barrier],
+                       log: RequestLog | None = None):
+    logger.info(f"Starting {scenario.name} on {url}")
+    stats: dict[str, PhaseStats] = {}
+    for phase in scenario.phases:
+        if phase.barrier is not None:
+            await barriers[phase.barrier].wait()
+        if phase.pause is not None:
+            await asyncio.sleep(phase.pause)
+        if phase.requests is None and phase.duration is None:
+            continue
+        if phase.sends_requests:
+            phase_stats = await run_phase(
+                session, url + phase.path, phase, log)
+        else:
+            # Nothing to send in this shard, keep in step with the others
+            await asyncio.sleep(phase.duration or 0)
+            phase_stats = PhaseStats()
+        stats[f"{scenario.name}/{phase.name}"] = phase_stats
+    total = PhaseStats()
+    for s in stats.values():
+        total.merge(s)
+    logger.info(f"Finished {scenario.name} on {url}: {total.summary()}")
+    return stats
 
 
-def _make_req(lb_dns, path):
-    requests.get(f"http://{lb_dns}{path}")
+async def run_phase(session: aiohttp.ClientSession,
+                    url: str,
+                    phase: Phase,
+                    log: RequestLog | None = None):
+    if phase.arrival == 'closed':
+        return await run_closed_loop(session, url, phase.concurrency,
+                                     phase.requests, phase.duration, log=log)
+    return await run_open_loop(session, url, phase.schedule(),
+                               phase.max_in_flight, log=log)
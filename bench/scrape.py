@@ -0,0 +1,78 @@
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.config import SCRAPE_INTERVAL, SCRAPE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Sample line of the Prometheus text format: name{labels} value
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)')
+
+
+class Scraper:
+    """Scrape the /metrics endpoint of the app instances every `interval`
+    seconds in a thread, while the context is open.
+
+    `samples` holds (instance, timestamp, name, labels, value) tuples.
+    """
+
+    def __init__(self, targets: dict[str, str], interval=SCRAPE_INTERVAL):
+        self.targets = targets
+        self.interval = interval
+        self.samples: list[tuple[str, float, str, str, float]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._session = requests.Session()
+        self._executor = ThreadPoolExecutor(max_workers=max(len(targets), 1))
+
+    def __enter__(self):
+        logger.info(f"Scraping {len(self.targets)} instances "
+                    f"every {self.interval} s")
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.scrape()
+        self._executor.shutdown()
+        self._session.close()
+
+    def scrape(self):
+        for samples in self._executor.map(self._scrape, self.targets.items()):
+            self.samples += samples
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            self.scrape()
+            self._stop.wait(self.interval - (time.monotonic() - start))
+
+    def _scrape(self, target: tuple[str, str]):
+        instance, address = target
+        timestamp = time.time()
+        try:
+            resp = self._session.get(f"http://{address}/metrics",
+                                     timeout=SCRAPE_TIMEOUT)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            logger.debug(f"Could not scrape {instance}: {e!r}")
+            return []
+        return [(instance, timestamp, name, labels, value)
+                for name, labels, value in parse_metrics(resp.text)]
+
+
+def parse_metrics(text: str):
+    """(name, labels, value) of the samples of a Prometheus text page"""
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_RE.match(line)
+        if match is not None:
+            name, labels, value = match.groups()
+            samples.append((name, labels or '', float(value)))
+    return samples
@@ -0,0 +1,302 @@
+import argparse
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+import orjson
+
+from bench.config import (
+    CLUSTER_1_PATH,
+    CLUSTER_2_PATH,
+    LOG_LEVEL,
+    RESULTS_STORE,
+)
+from bench.utils import to_timestamp
+
+if TYPE_CHECKING:
+    from mypy_boto3_cloudwatch.type_defs import MetricDataResultTypeDef
+
+logger = logging.getLogger(__name__)
+
+# Cluster path of the CloudWatch results of each target group
+TARGET_GROUP_CLUSTERS = {
+    'tg1': CLUSTER_1_PATH,
+    'tg2': CLUSTER_2_PATH,
+    'load_balancer': '*',
+}
+CLIENT_COLUMNS = ('requests', 'errors', 'late', 'dropped',
+                  'p50', 'p90', 'p99', 'p99.9', 'max')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS points (
+    metric TEXT NOT NULL,
+    target_group TEXT NOT NULL,
+    run TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    cluster TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (metric, target_group, run, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS points_run ON points (run, target_group, metric);
+CREATE TABLE IF NOT EXISTS client (
+    run TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    late INTEGER NOT NULL,
+    dropped INTEGER NOT NULL,
+    p50 REAL NOT NULL,
+    p90 REAL NOT NULL,
+    p99 REAL NOT NULL,
+    "p99.9" REAL NOT NULL,
+    max REAL NOT NULL,
+    histogram BLOB NOT NULL,
+    PRIMARY KEY (run, cluster, phase)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS client_breakdown (
+    run TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    component TEXT NOT NULL,
+    histogram BLOB NOT NULL,
+    PRIMARY KEY (run, cluster, phase, component)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS app_metrics (
+    run TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    ts REAL NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (run, name, instance, labels, ts)
+) WITHOUT ROWID;
+"""
+
+
+class ResultStore:
+    """CloudWatch series and client-side statistics of every run.
+
+    Points are keyed by metric, target group, run and timestamp so that
+    the series of a metric across runs is a range scan of the primary key,
+    the results of one run being reached through the `points_run` index.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def add_metrics(self,
+                    run: str,
+                    target_group: str,
+                    data: list['MetricDataResultTypeDef']):
+        """Save the CloudWatch results of a target group ('tg1', 'tg2' or
+        'load_balancer')"""
+        cluster = TARGET_GROUP_CLUSTERS[target_group]
+        rows = [(item['Label'], target_group, run, to_timestamp(t),
+                 cluster, v)
+                for item in data
+                for t, v in zip(item['Timestamps'], item['Values'])]
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+            self._touch(run)
+
+    def add_client(self, run: str, stats: dict[str, dict[str, dict]]):
+        """Save the client-side statistics of each cluster path and phase,
+        as returned by `PhaseStats.to_dict`"""
+        rows = [(run, cluster, phase,
+                 *(s[column] for column in CLIENT_COLUMNS),
+                 orjson.dumps(s['histogram']))
+                for cluster, phases in stats.items()
+                for phase, s in phases.items()]
+        breakdown_rows = [
+            (run, cluster, phase, component, orjson.dumps(histogram))
+            for cluster, phases in stats.items()
+            for phase, s in phases.items()
+            for component, histogram in s.get('breakdown', {}).items()]
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO client VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self._db.executemany(
+                'INSERT OR REPLACE INTO client_breakdown VALUES '
+                '(?, ?, ?, ?, ?)', breakdown_rows)
+            self._touch(run)
+
+    def add_app_metrics(self,
+                        run: str,
+                        samples: list[tuple[str, float, str, str, float]]):
+        """Save the samples scraped from the app instances, as
+        (instance, timestamp, name, labels, value) tuples"""
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO app_metrics VALUES (?, ?, ?, ?, ?, ?)',
+                [(run, instance, name, labels, ts, value)
+                 for instance, ts, name, labels, value in samples])
+            self._touch(run)
+
+    def runs(self):
+        """Runs and the time they were last updated, oldest run first"""
+        return dict(self._db.execute(
+            'SELECT run, updated FROM runs ORDER BY run'))
+
+    def load_metrics(self,
+                     run: str,
+                     target_group: str,
+                     metrics: list[str] | None = None):
+        """Series of a target group as (timestamps, values) arrays
+        by metric"""
+        query = 'SELECT metric, ts, value FROM points ' \
+            'WHERE run = ? AND target_group = ?'
+        params: list = [run, target_group]
+        if metrics is not None:
+            query += f" AND metric IN ({', '.join('?' * len(metrics))})"
+            params += metrics
+        rows = self._db.execute(query + ' ORDER BY metric, ts', params)
+        return _group_series(rows)
+
+    def series(self,
+               metric: str,
+               target_group: str,
+               runs: list[str] | None = None):
+        """Series of a metric of a target group as (timestamps, values)
+        arrays by run"""
+        query = 'SELECT run, ts, value FROM points ' \
+            'WHERE metric = ? AND target_group = ?'
+        params: list = [metric, target_group]
+        if runs is not None:
+            query += f" AND run IN ({', '.join('?' * len(runs))})"
+            params += runs
+        rows = self._db.execute(query + ' ORDER BY run, ts', params)
+        return _group_series(rows)
+
+    def load_client(self, run: str):
+        """Client-side statistics of a run, in the format of `add_client`"""
+        columns = ', '.join(f'"{c}"' for c in CLIENT_COLUMNS)
+        rows = self._db.execute(
+            f"SELECT cluster, phase, {columns}, histogram FROM client "
+            'WHERE run = ? ORDER BY cluster, phase', (run,))
+        stats: dict[str, dict[str, dict]] = {}
+        for cluster, phase, *values, histogram in rows:
+            stats.setdefault(cluster, {})[phase] = {
+                **dict(zip(CLIENT_COLUMNS, values)),
+                'histogram': orjson.loads(histogram),
+                'breakdown': {},
+            }
+        rows = self._db.execute(
+            'SELECT cluster, phase, component, histogram '
+            'FROM client_breakdown WHERE run = ?', (run,))
+        for cluster, phase, component, histogram in rows:
+            stats[cluster][phase]['breakdown'][component] = \
+                orjson.loads(histogram)
+        return stats
+
+    def load_app_metrics(self, run: str, name: str):
+        """Samples of a metric scraped from the app instances, as
+        (timestamps, values) arrays by (instance, labels)"""
+        rows = self._db.execute(
+            'SELECT instance, labels, ts, value FROM app_metrics '
+            'WHERE run = ? AND name = ? ORDER BY instance, labels, ts',
+            (run, name)).fetchall()
+        series: dict[tuple[str, str], tuple[np.ndarray, np.ndarray]] = {}
+        for instance, labels, ts, value in rows:
+            series.setdefault((instance, labels), ([], []))
+            series[instance, labels][0].append(ts)
+            series[instance, labels][1].append(value)
+        return {key: (np.array(ts, float), np.array(values, float))
+                for key, (ts, values) in series.items()}
+
+    def import_run(self, run_dir: Path):
+        """Import the JSON results written by previous versions of the
+        benchmark in `run_dir`"""
+        for target_group in TARGET_GROUP_CLUSTERS:
+            path = run_dir / f"{target_group}.json"
+            if path.exists():
+                data = orjson.loads(path.read_bytes())
+                for item in data:
+                    item['Timestamps'] = [
+                        datetime.fromisoformat(t) for t in item['Timestamps']]
+                self.add_metrics(run_dir.name, target_group, data)
+        path = run_dir / 'client.json'
+        if path.exists():
+            self.add_client(run_dir.name, orjson.loads(path.read_bytes()))
+
+    def import_results(self, results: Path):
+        """Import the JSON results of the runs missing from the store"""
+        runs = self.runs()
+        imported = []
+        for run_dir in sorted(results.iterdir()):
+            files = [*TARGET_GROUP_CLUSTERS, 'client']
+            if run_dir.is_dir() and run_dir.name not in runs \
+                    and any((run_dir / f"{f}.json").exists() for f in files):
+                logger.info(f"Importing {run_dir}")
+                self.import_run(run_dir)
+                imported.append(run_dir.name)
+        return imported
+
+    def _touch(self, run: str):
+        self._db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?)',
+                         (run, time.time()))
+
+
+def open_store(results: Path):
+    """Store of the results directory, importing the JSON results of the
+    runs it does not hold yet"""
+    store = ResultStore(results / RESULTS_STORE)
+    store.import_results(results)
+    return store
+
+
+def _group_series(rows):
+    """Group (key, ts, value) rows sorted by key in (timestamps, values)
+    arrays"""
+    rows = list(rows)
+    series: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+    if len(rows) == 0:
+        return series
+    keys, ts, values = zip(*rows)
+    ts = np.array(ts, 'datetime64[s]')
+    values = np.array(values, float)
+    keys = np.array(keys)
+    bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    for start, end in zip([0, *bounds], [*bounds, len(keys)]):
+        series[str(keys[start])] = (ts[start:end], values[start:end])
+    return series
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python3 -m bench.store',
+        description='Import the JSON results of previous runs in the store')
+    parser.add_argument('results', nargs='?', type=Path,
+                        default=Path('results'),
+                        help='results directory (default: %(default)s)')
+    args = parser.parse_args()
+    with ResultStore(args.results / RESULTS_STORE) as store:
+        imported = store.import_results(args.results)
+    logger.info(f"Imported {len(imported)} runs")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL)
+    main()
@@ -0,0 +1,266 @@
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+import orjson
+
+from bench.config import (
+    BOOTSTRAP_RESAMPLES,
+    CLUSTER_1_INSTANCE_TYPE,
+    CLUSTER_1_PATH,
+    CLUSTER_2_INSTANCE_TYPE,
+    CLUSTER_2_PATH,
+    LOG_LEVEL,
+    RESULTS_STORE,
+)
+from bench.histogram import LatencyHistogram
+from bench.store import ResultStore
+
+logger = logging.getLogger(__name__)
+
+# (target group, cluster path, instance type) of the compared clusters
+CLUSTERS = {
+    'cluster1': ('tg1', CLUSTER_1_PATH, CLUSTER_1_INSTANCE_TYPE),
+    'cluster2': ('tg2', CLUSTER_2_PATH, CLUSTER_2_INSTANCE_TYPE),
+}
+METRICS = ('RequestCount', 'HTTPCode_Target_2XX_Count',
+           'TargetConnectionErrorCount', 'TargetResponseTime',
+           'TargetResponseTime_p99', 'HealthyHostCount')
+
+
+def summarize(run_dir: Path):
+    """Compare the clusters of a run, save `summary.json` and `summary.txt`
+    in its directory and return the summary"""
+    with ResultStore(run_dir.parent / RESULTS_STORE) as store:
+        if run_dir.name not in store.runs():
+            store.import_run(run_dir)
+        timestamps, series = load_run(store, run_dir.name)
+        client = _load_client(store, run_dir.name)
+    period = float(np.min(np.diff(timestamps)).astype('timedelta64[s]')
+                   .astype(float)) if len(timestamps) > 1 else 60.
+
+    clusters = {}
+    for name, (_, path, instance_type) in CLUSTERS.items():
+        clusters[name] = {
+            'instance_type': instance_type,
+            **_cluster_stats(series[name], period),
+            'client': client.get(path),
+        }
+    summary = {
+        'run': run_dir.name,
+        'period': period,
+        'minutes': len(timestamps),
+        'clusters': clusters,
+        'ratios': _ratios(series['cluster1'], series['cluster2'], period),
+    }
+    (run_dir / 'summary.json').write_bytes(
+        orjson.dumps(summary, option=orjson.OPT_SERIALIZE_NUMPY))
+    text = format_summary(summary)
+    (run_dir / 'summary.txt').write_text(text)
+    logger.info('\n' + text)
+    return summary
+
+
+def load_run(store: ResultStore, run: str):
+    """Load the CloudWatch results of the clusters of a run as arrays of
+    shape (len(METRICS), len(timestamps)) aligned on the same timestamps,
+    missing points being NaN"""
+    raw = {name: store.load_metrics(run, target_group, list(METRICS))
+           for name, (target_group, _, _) in CLUSTERS.items()}
+    timestamps = np.unique(np.concatenate([
+        ts for results in raw.values() for ts, _ in results.values()
+    ] or [np.empty(0, 'datetime64[s]')]))
+    series = {}
+    for name, results in raw.items():
+        array = np.full((len(METRICS), len(timestamps)), np.nan)
+        for i, metric in enumerate(METRICS):
+            if metric in results:
+                ts, values = results[metric]
+                array[i, np.searchsorted(timestamps, ts)] = values
+        series[name] = array
+    return timestamps, series
+
+
+def format_summary(summary: dict):
+    rows = [('', *(f"{name} ({c['instance_type']})"
+                   for name, c in summary['clusters'].items()),
+             'ratio 1/2 [95% CI]')]
+    ratios = summary['ratios']
+    for key, label, fmt in (
+            ('throughput', 'Throughput (req/s)', '{:.2f}'),
+            ('latency', 'Mean response time (ms)', '{:.2f}'),
+            ('latency_p99', 'Worst minute p99 response time (ms)', '{:.2f}'),
+            ('error_rate', 'Error rate (%)', '{:.3f}'),
+            ('requests_per_host', 'Requests/s per healthy host', '{:.2f}')):
+        scale = 1000 if key.startswith('latency') else \
+            100 if key == 'error_rate' else 1
+        cells = [fmt.format(c[key] * scale) if c[key] is not None else '-'
+                 for c in summary['clusters'].values()]
+        ratio = ratios.get(key)
+        cells.append(
+            f"{ratio['value']:.2f} [{ratio['low']:.2f}, {ratio['high']:.2f}]"
+            if ratio is not None else '-')
+        rows.append((label, *cells))
+    for key in ('p50', 'p99', 'max'):
+        rows.append((f"Client {key} latency (ms)", *(
+            f"{c['client'][key] * 1000:.2f}" if c['client'] is not None
+            else '-'
+            for c in summary['clusters'].values()), ''))
+    for component in ('client', 'network', 'app'):
+        for key in ('p50', 'p99'):
+            rows.append((f"  {component} {key} (ms)", *(
+                f"{c['client']['breakdown'][component][key] * 1000:.2f}"
+                if c['client'] is not None
+                and component in c['client']['breakdown'] else '-'
+                for c in summary['clusters'].values()), ''))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(w) for cell, w in zip(row, widths))
+                     .rstrip() for row in rows) + '\n'
+
+
+def _load_client(store: ResultStore, run: str):
+    """Client-side latencies of each cluster path, all phases merged, and
+    their breakdown in client, network and app times"""
+    client = {}
+    for cluster, phases in store.load_client(run).items():
+        histogram = LatencyHistogram()
+        breakdown: dict[str, LatencyHistogram] = {}
+        requests = errors = 0
+        for phase in phases.values():
+            histogram.merge(LatencyHistogram.from_dict(phase['histogram']))
+            for component, data in phase['breakdown'].items():
+                breakdown.setdefault(component, LatencyHistogram()) \
+                    .merge(LatencyHistogram.from_dict(data))
+            requests += phase['requests']
+            errors += phase['errors']
+        client[cluster] = {
+            'requests': requests,
+            'errors': errors,
+            **histogram.summary(),
+            'breakdown': {component: h.summary()
+                          for component, h in breakdown.items()
+                          if h.total > 0},
+        }
+    return client
+
+
+def _cluster_stats(array: np.ndarray, period: float):
+    requests, ok, conn_errors, latency, latency_p99, healthy = array
+    total = np.nansum(requests)
+    errors = float(np.sum(_minute_errors(array)))
+    weights = np.where(np.isnan(latency), 0, np.nan_to_num(requests))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        throughput = _nanmean(requests)
+        per_host = _nanmean(requests / healthy)
+    return {
+        'requests': total,
+        'errors': errors,
+        'throughput': throughput / period if throughput is not None else None,
+        'latency': float(np.sum(weights * np.nan_to_num(latency))
+                         / np.sum(weights)) if np.sum(weights) else None,
+        'latency_p99': _nanmax(latency_p99),
+        'error_rate': errors / total if total else None,
+        'requests_per_host': per_host / period
+        if per_host is not None else None,
+    }
+
+
+def _minute_errors(array: np.ndarray):
+    """Errors of each minute: requests without a 2XX response, counted as
+    0 when there is no 2XX series at all, plus connection errors"""
+    requests, ok, conn_errors, _, _, _ = array
+    errors = np.nan_to_num(conn_errors)
+    if not np.all(np.isnan(ok)):
+        errors = errors + np.nan_to_num(requests) - np.nan_to_num(ok)
+    return errors
+
+
+def _ratios(array1: np.ndarray, array2: np.ndarray, period: float):
+    """Ratios cluster1 / cluster2 with bootstrap 95% confidence intervals,
+    resampling the minutes of each cluster independently. Each ratio uses
+    the same statistic as `_cluster_stats`."""
+    rng = np.random.default_rng(0)
+
+    def resample(columns: tuple[np.ndarray, ...]):
+        """Minutes where all the columns are defined, and resamples of
+        them"""
+        valid = np.all([np.isfinite(column) for column in columns], axis=0)
+        columns = tuple(column[valid] for column in columns)
+        nb_minutes = int(valid.sum())
+        if nb_minutes == 0:
+            return None
+        indices = rng.integers(0, nb_minutes,
+                               (BOOTSTRAP_RESAMPLES, nb_minutes))
+        return columns, tuple(column[indices] for column in columns)
+
+    def ratio(columns1: tuple[np.ndarray, ...],
+              columns2: tuple[np.ndarray, ...],
+              statistic):
+        samples1, samples2 = resample(columns1), resample(columns2)
+        if samples1 is None or samples2 is None:
+            return None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = statistic(*samples1[0]) / statistic(*samples2[0])
+            boot = statistic(*samples1[1]) / statistic(*samples2[1])
+        if not np.isfinite(value):
+            return None
+        low, high = np.nanpercentile(boot, [2.5, 97.5])
+        return {'value': float(value), 'low': float(low), 'high': float(high)}
+
+    def mean(values: np.ndarray):
+        return values.mean(axis=-1)
+
+    def p99_max(values: np.ndarray):
+        return values.max(axis=-1)
+
+    def weighted_mean(values: np.ndarray, weights: np.ndarray):
+        return (weights * values).sum(axis=-1) / weights.sum(axis=-1)
+
+    def error_rate(requests: np.ndarray, errors: np.ndarray):
+        return errors.sum(axis=-1) / requests.sum(axis=-1)
+
+    def latency_columns(array: np.ndarray):
+        requests, _, _, latency, _, _ = array
+        return latency, np.nan_to_num(requests)
+
+    def error_columns(array: np.ndarray):
+        return np.nan_to_num(array[0]), _minute_errors(array)
+
+    requests1, _, _, _, p99_1, healthy1 = array1
+    requests2, _, _, _, p99_2, healthy2 = array2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = {
+            'throughput': ratio((requests1,), (requests2,), mean),
+            'latency': ratio(latency_columns(array1),
+                             latency_columns(array2), weighted_mean),
+            'latency_p99': ratio((p99_1,), (p99_2,), p99_max),
+            'error_rate': ratio(error_columns(array1),
+                                error_columns(array2), error_rate),
+            'requests_per_host': ratio(
+                (requests1 / healthy1,), (requests2 / healthy2,), mean),
+        }
+    return {key: value for key, value in ratios.items() if value is not None}
+
+
+def _nanmean(values: np.ndarray):
+    values = values[np.isfinite(values)]
+    return float(values.mean()) if len(values) else None
+
+
+def _nanmax(values: np.ndarray):
+    values = values[np.isfinite(values)]
+    return float(values.max()) if len(values) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m bench.summary')
+    parser.add_argument('run_dir', type=Path,
+                        help='results directory of the run')
+    args = parser.parse_args()
+    summarize(args.run_dir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL)
+    main()
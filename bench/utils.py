@@ -1,14 +1,27 @@
 import logging
+import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import count
+from pathlib import Path
 
 import boto3
+import requests
 
-from bench.config import CLUSTER_1_TARGET_NAME, CLUSTER_2_TARGET_NAME
+from bench.config import (
+    CLUSTER_1_TARGET_NAME,
+    CLUSTER_2_TARGET_NAME,
+    TARGETS_READY_MAX_DELAY,
+    TARGETS_READY_TIMEOUT,
+)
 
 logger = logging.getLogger(__name__)
 
 elbv2_cli = boto3.client('elbv2')
 cw_cli = boto3.client('cloudwatch')
+ec2_cli = boto3.client('ec2')
 
 SPECIFIER_RE = re.compile(r'[^:\/]+\/[^\/]+\/[a-z0-9]+$')
 
@@ -18,6 +31,45 @@ def wait_lb(name: str):
     waiter.wait(Names=[name])
 
 
+def wait_targets_healthy(tg_names: list[str]):
+    """Wait until all the registered targets of the target groups are
+    healthy, and each target group has one at least, so that the bench does
+    not start on a partial or empty cluster. Same as
+    `deploy.ready.wait_targets_healthy`, which the bench image lacks."""
+    deadline = time.monotonic() + TARGETS_READY_TIMEOUT
+    tg_arns = [get_tg_arn(name) for name in tg_names]
+    with ThreadPoolExecutor(max_workers=len(tg_arns)) as executor:
+        for attempt in count():
+            states = list(executor.map(_target_states, tg_arns))
+            unhealthy = _not_ready(tg_arns, states)
+            if not unhealthy:
+                return
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Targets not healthy: {unhealthy}")
+            logger.info(f"Waiting for targets: {unhealthy}")
+            time.sleep(random.uniform(
+                0, min(2 ** attempt, TARGETS_READY_MAX_DELAY)))
+
+
+def _not_ready(tg_arns: list[str], states: list[dict[str, str | None]]):
+    """State of the targets that are not ready, by ID, and of the target
+    groups without any registered target (draining ones excepted), by ARN"""
+    unhealthy = {target_id: state
+                 for tg_states in states
+                 for target_id, state in tg_states.items()
+                 if state not in ('healthy', 'draining')}
+    for tg_arn, tg_states in zip(tg_arns, states):
+        if all(state == 'draining' for state in tg_states.values()):
+            unhealthy[tg_arn] = 'no registered target'
+    return unhealthy
+
+
+def _target_states(tg_arn: str):
+    health = elbv2_cli.describe_target_health(TargetGroupArn=tg_arn)
+    return {desc['Target']['Id']: desc.get('TargetHealth', {}).get('State')
+            for desc in health['TargetHealthDescriptions']}
+
+
 def get_lb_arn_dns(name: str):
     lbs = elbv2_cli.describe_load_balancers(Names=[name])
     if len(lbs['LoadBalancers']) == 0:
@@ -43,6 +95,60 @@ def get_tg_arn(name: str):
     return tg_arn
 
 
+def get_instance_addresses(name: str):
+    """Public IP address of each running instance tagged `Name=name`"""
+    addresses = {}
+    paginator = ec2_cli.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[
+        {'Name': 'tag:Name', 'Values': [name]},
+        {'Name': 'instance-state-name', 'Values': ['running']},
+    ]):
+        for reservation in page['Reservations']:
+            for instance in reservation.get('Instances', []):
+                ip = instance.get('PublicIpAddress')
+                if ip is not None:
+                    addresses[instance['InstanceId']] = ip
+    return addresses
+
+
+def get_local_targets(lb_address: str):
+    """Address of each target of the local load balancer"""
+    resp = requests.get(f"http://{lb_address}/_localalb/targets")
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_local_metric_data(lb_address: str,
+                          start_time: datetime,
+                          end_time: datetime,
+                          tg_name: str | None = None):
+    """Fetch metrics from the local load balancer (`bench.localalb`)"""
+    params = {'start': start_time.isoformat(), 'end': end_time.isoformat()}
+    if tg_name is not None:
+        params['target_group'] = tg_name
+    resp = requests.get(f"http://{lb_address}/_localalb/metrics",
+                        params=params)
+    resp.raise_for_status()
+    data = resp.json()
+    for item in data:
+        item['Timestamps'] = [
+            datetime.fromisoformat(t) for t in item['Timestamps']]
+    return data
+
+
+def results_dir(start_time: datetime):
+    path = Path(f"./results/{start_time.strftime(r'%Y-%m-%dT%H_%M')}")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def to_timestamp(t: datetime):
+    """POSIX timestamp of `t`, naive datetimes being UTC"""
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return int(t.timestamp())
+
+
 def specifier_from_arn(arn: str):
     search = SPECIFIER_RE.search(arn)
     if search is None:
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import multiprocessing as mp
+import queue
+import threading
+from multiprocessing.context import SpawnContext
+from pathlib import Path
+
+from bench.config import LOG_LEVEL
+from bench.engine import PhaseStats
+from bench.reqlog import RequestLog
+from bench.scenarios import run_scenarios, run_scenarios_async
+from bench.workload import Workload
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessBarrier:
+    """asyncio wrapper of a barrier shared by worker processes"""
+
+    def __init__(self, barrier: threading.Barrier):
+        self._barrier = barrier
+
+    async def wait(self):
+        return await asyncio.to_thread(self._barrier.wait)
+
+
+def run_workers(lb_dns: str,
+                path: str,
+                workload: Workload,
+                nb_workers: int,
+                log_dir: Path | None = None):
+    """Run `workload` on `path` with its virtual users and request rates
+    sharded over `nb_workers` processes, return the merged statistics.
+    Each process logs its requests in `log_dir` if given."""
+    if nb_workers <= 1:
+        log = RequestLog(_log_path(log_dir, path, 0)) \
+            if log_dir is not None else None
+        try:
+            return run_scenarios(lb_dns, path, workload, log)
+        finally:
+            if log is not None:
+                log.close()
+
+    ctx = mp.get_context('spawn')
+    start = ctx.Barrier(nb_workers)
+    barriers = {name: ctx.Barrier(parties * nb_workers)
+                for name, parties in workload.barrier_parties().items()}
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_worker,
+                    args=(lb_dns, path, workload.shard(i, nb_workers),
+                          start, barriers, results,
+                          _log_path(log_dir, path, i)
+                          if log_dir is not None else None, i),
+                    name=f"bench-worker-{i}")
+        for i in range(nb_workers)
+    ]
+    for p in processes:
+        p.start()
+    try:
+        stats = _collect(processes, results)
+    except BaseException:
+        # The other workers are not all interrupted (without barriers, they
+        # run their whole shard) and nobody reads their results any more,
+        # so they would block on the queue and never exit
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        raise
+    finally:
+        for p in processes:
+            p.join()
+    return stats
+
+
+def _worker(lb_dns: str,
+            path: str,
+            workload: Workload,
+            start: threading.Barrier,
+            barriers: dict[str, threading.Barrier],
+            results: 'mp.Queue',
+            log_path: Path | None,
+            index: int):
+    logging.basicConfig(level=LOG_LEVEL)
+    log = RequestLog(log_path, index) if log_path is not None else None
+    try:
+        start.wait()
+        stats = asyncio.run(run_scenarios_async(
+            lb_dns, path, workload,
+            {name: ProcessBarrier(b) for name, b in barriers.items()},
+            log))
+        results.put(stats)
+    except BaseException as e:
+        # Release the other workers instead of letting them wait forever
+        for b in (start, *barriers.values()):
+            b.abort()
+        results.put(e)
+        raise
+    finally:
+        if log is not None:
+            log.close()
+
+
+def _log_path(log_dir: Path, path: str, index: int):
+    name = path.strip('/').replace('/', '_') or 'root'
+    return log_dir / f"{name}-{index}.bin"
+
+
+def _collect(processes: list[SpawnContext.Process], results: 'mp.Queue'):
+    merged: dict[str, PhaseStats] = {}
+    for _ in processes:
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError('A bench worker died unexpectedly')
+        if isinstance(result, BaseException):
+            raise RuntimeError('A bench worker failed') from result
+        for phase, stats in result.items():
+            merged.setdefault(phase, PhaseStats()).merge(stats)
+    return merged
@@ -0,0 +1,211 @@
+import tomllib
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Iterator
+
+from bench import arrivals
+from bench.config import (
+    ARRIVAL,
+    CLUSTER_1_PATH,
+    CLUSTER_2_PATH,
+    CONCURRENCY,
+    KEEP_ALIVE,
+    MAX_IN_FLIGHT,
+    RATE,
+)
+
+DEFAULT_WORKLOAD = Path(__file__).parent / 'workloads' / 'default.toml'
+
+ARRIVALS = ('closed', 'constant', 'poisson', 'ramp', 'steps')
+
+
+@dataclass
+class Phase:
+    name: str
+    # Wait for every scenario using the same barrier before starting
+    barrier: str | None = None
+    # Only sleep for this many seconds
+    pause: float | None = None
+    # The phase ends after `requests` requests and/or `duration` seconds
+    requests: int | None = None
+    duration: float | None = None
+    # Appended to the target path, e.g. '/cpu?iterations=5000'
+    path: str = ''
+    arrival: str = ARRIVAL
+    # Closed loop: number of virtual users
+    concurrency: int = CONCURRENCY
+    # Open loop: requests per second ('constant', 'poisson' and 'ramp')
+    rate: float = RATE
+    start_rate: float = 0.
+    # Open loop: list of (rate, duration) for 'steps'
+    stages: list[tuple[float, float]] = field(default_factory=list)
+    max_in_flight: int = MAX_IN_FLIGHT
+    # Open loop: shift of the schedule, used to interleave worker processes
+    offset: float = 0.
+
+    def schedule(self) -> Iterator[float]:
+        match self.arrival:
+            case 'constant':
+                schedule = arrivals.constant(self.rate)
+            case 'poisson':
+                schedule = arrivals.poisson(self.rate)
+            case 'ramp':
+                if self.duration is None:
+                    raise ValueError(f"Ramp phase {self.name} needs a duration")
+                schedule = arrivals.ramp(
+                    self.start_rate, self.rate, self.duration)
+            case 'steps':
+                schedule = arrivals.steps(self.stages)
+            case _:
+                raise ValueError(
+                    f"Phase {self.name} has no schedule ({self.arrival=})")
+        if self.offset:
+            schedule = (t + self.offset for t in schedule)
+        return arrivals.limit(schedule, self.requests, self.duration)
+
+    def shard(self, index: int, nb_shards: int):
+        """Part of this phase run by shard `index` out of `nb_shards`.
+        Requests and virtual users are split exactly, rates evenly."""
+        base_rate = self.stages[0][0] if self.arrival == 'steps' \
+            else self.rate
+        # Closed loop: only shards with at least one virtual user get requests
+        request_shards = min(self.concurrency, nb_shards) \
+            if self.arrival == 'closed' else nb_shards
+        requests = self.requests
+        if requests is not None:
+            requests = _split(requests, index, request_shards) \
+                if index < request_shards else 0
+        return replace(
+            self,
+            requests=requests,
+            concurrency=_split(self.concurrency, index, nb_shards),
+            rate=self.rate / nb_shards,
+            start_rate=self.start_rate / nb_shards,
+            stages=[(rate / nb_shards, duration)
+                    for rate, duration in self.stages],
+            max_in_flight=max(1, -(-self.max_in_flight // nb_shards)),
+            offset=self.offset + index / base_rate if base_rate else 0.,
+        )
+
+    @property
+    def sends_requests(self):
+        if self.requests == 0:
+            return False
+        if self.arrival == 'closed':
+            return self.concurrency > 0 and (
+                self.requests is not None or self.duration is not None)
+        return self.requests is not None or self.duration is not None
+
+    @property
+    def pool_size(self):
+        return self.concurrency if self.arrival == 'closed' \
+            else self.max_in_flight
+
+
+@dataclass
+class Scenario:
+    name: str
+    phases: list[Phase]
+
+
+@dataclass
+class Workload:
+    # Scenarios all run at the same time, once per target path
+    scenarios: list[Scenario]
+    targets: list[str] = field(
+        default_factory=lambda: [CLUSTER_1_PATH, CLUSTER_2_PATH])
+    keep_alive: bool = KEEP_ALIVE
+
+    def barrier_parties(self):
+        """Number of scenarios waiting on each barrier"""
+        return Counter(barrier
+                       for scenario in self.scenarios
+                       for barrier in {phase.barrier
+                                       for phase in scenario.phases
+                                       if phase.barrier is not None})
+
+    @property
+    def pool_size(self):
+        return max(1, sum(max(phase.pool_size for phase in scenario.phases)
+                          for scenario in self.scenarios))
+
+    def shard(self, index: int, nb_shards: int):
+        return replace(self, scenarios=[
+            replace(scenario, phases=[phase.shard(index, nb_shards)
+                                      for phase in scenario.phases])
+            for scenario in self.scenarios
+        ])
+
+
+def load_workload(path: Path = DEFAULT_WORKLOAD):
+    with open(path, 'rb') as f:
+        data = tomllib.load(f)
+    scenarios = [_parse_scenario(s) for s in data.pop('scenarios', [])]
+    if len(scenarios) == 0:
+        raise ValueError(f"No scenario defined in {path}")
+    return Workload(scenarios=scenarios, **data)
+
+
+def _parse_scenario(data: dict):
+    name = data['name']
+    phases = [
+        _parse_phase(p, f"phase{i + 1}")
+        for i, p in enumerate(data.get('phases', []))
+    ]
+    if len(phases) == 0:
+        raise ValueError(f"Scenario {name} has no phase")
+    return Scenario(name=name, phases=phases)
+
+
+def _split(total: int, index: int, nb_shards: int):
+    share, remainder = divmod(total, nb_shards)
+    return share + (index < remainder)
+
+
+def _parse_phase(data: dict, default_name: str):
+    data = {'name': default_name, **data}
+    phase = Phase(**data)
+    phase.stages = [(rate, duration) for rate, duration in phase.stages]
+    if phase.arrival not in ARRIVALS:
+        raise ValueError(f"Unknown arrival mode: {phase.arrival}")
+    if phase.arrival == 'steps' and phase.requests is None \
+            and phase.duration is None:
+        phase.duration = sum(duration for _, duration in phase.stages)
+    if phase.pause is None and phase.requests is None \
+            and phase.duration is None:
+        raise ValueError(
+            f"Phase {phase.name} needs a pause, a number of requests "
+            "or a duration")
+    if phase.arrival != 'closed' and (phase.requests is not None
+                                      or phase.duration is not None):
+        _check_schedule(phase)
+    return phase
+
+
+def _check_schedule(phase: Phase):
+    """Reject the rates and durations the arrival schedules cannot use,
+    before they fail in the middle of a run"""
+    match phase.arrival:
+        case 'constant' | 'poisson':
+            if phase.rate <= 0:
+                raise ValueError(
+                    f"Phase {phase.name}: rate must be positive, "
+                    f"got {phase.rate}")
+        case 'ramp':
+            if phase.duration is None or phase.duration <= 0:
+                raise ValueError(
+                    f"Ramp phase {phase.name} needs a positive duration, "
+                    f"got {phase.duration}")
+            if phase.start_rate < 0 or phase.rate < 0:
+                raise ValueError(
+                    f"Ramp phase {phase.name}: rates cannot be negative")
+        case 'steps':
+            if len(phase.stages) == 0:
+                raise ValueError(f"Steps phase {phase.name} has no stage")
+            for rate, duration in phase.stages:
+                if rate <= 0 or duration < 0:
+                    raise ValueError(
+                        f"Steps phase {phase.name}: stage rates must be "
+                        f"positive and durations not negative, "
+                        f"got ({rate}, {duration})")
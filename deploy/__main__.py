@@ -1,35 +1,55 @@
+import argparse
 import asyncio
 import logging
 
-from deploy.bootstrap import bootstrap_instance
-from deploy.config import LOG_LEVEL
+from deploy.bootstrap import bootstrap_instance, deployed_digests
+from deploy.bundle import make_source_bundle
+from deploy.config import BUILD_ON_INSTANCES, LOG_LEVEL
+from deploy.image import build_image
 from deploy.infra import setup_infra
+from deploy.ready import wait_ready
+from deploy.ssh import SSHPool
 
 logger = logging.getLogger(__name__)
 
 
-async def main():
+async def main(reconcile: bool = False):
+    bundle = make_source_bundle()
     logger.info('Setting up infrastructure')
-    instances_m4, instances_t2 = await setup_infra()
-
-    # Use this to use existing instance instead of creating new ones
-    # instances = ec2_res.instances.filter(
-    #     Filters=[
-    #         {'Name': 'tag:Name', 'Values': [AWS_RES_NAME]},
-    #         {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
-    #     ]
-    # )
-
-    logger.info('Bootstrapping instances')
-    async with asyncio.TaskGroup() as tg:
-        for inst in instances_m4:
-            tg.create_task(
-                asyncio.to_thread(bootstrap_instance, inst, '/cluster1'))
-        for inst in instances_t2:
-            tg.create_task(
-                asyncio.to_thread(bootstrap_instance, inst, '/cluster2'))
+    # Build the image while the instances boot. A failed build is only
+    # raised once they are provisioned, so that it does not interrupt it.
+    image = None if BUILD_ON_INSTANCES \
+        else asyncio.create_task(asyncio.to_thread(build_image))
+    instances_m4, instances_t2 = await setup_infra(reconcile)
+    archive = await image if image is not None else None
+
+    targets = [(inst, '/cluster1') for inst in instances_m4] \
+        + [(inst, '/cluster2') for inst in instances_t2]
+    stale = targets
+    with SSHPool() as pool:
+        if reconcile:
+            digests = await deployed_digests(
+                pool, [inst for inst, _ in targets])
+            for inst, _ in targets:
+                if digests[inst.id] == bundle.digest:
+                    logger.info(f"{inst.id} is up to date")
+            stale = [(inst, route_rule) for inst, route_rule in targets
+                     if digests[inst.id] != bundle.digest]
+
+        logger.info('Bootstrapping instances')
+        async with asyncio.TaskGroup() as tg:
+            for inst, route_rule in stale:
+                tg.create_task(pool.call(bootstrap_instance, pool, inst,
+                                         route_rule, bundle, archive))
+
+    logger.info('Waiting for the targets to be ready')
+    await wait_ready(targets)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m deploy')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='reuse the resources of a previous deployment')
+    args = parser.parse_args()
     logging.basicConfig(level=LOG_LEVEL)
-    asyncio.run(main())
+    asyncio.run(main(args.reconcile))
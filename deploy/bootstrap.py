@@ -1,88 +1,97 @@
 import io
 import logging
-import tarfile
+import shlex
 from typing import TYPE_CHECKING
 
 import backoff
-import requests
-from paramiko import AutoAddPolicy, RSAKey, SSHClient, ssh_exception
+from paramiko import ssh_exception
 
-from deploy.config import AWS_KEY_PAIR_NAME, SSH_USERNAME
-from deploy.utils import SSHExecError, ssh_exec
+from deploy.bundle import SourceBundle
+from deploy.config import APP_ENV, APP_IMAGE
+from deploy.image import ImageArchive, upload_image
+from deploy.ssh import SSHPool
+from deploy.utils import SSHExecError
 
 if TYPE_CHECKING:
     from mypy_boto3_ec2.service_resource import Instance
 
 logger = logging.getLogger(__name__)
 
+# Digest of the source bundle of the running app, written on the instances
+DEPLOYED_DIGEST_PATH = 'deployed.sha256'
+
 
 @backoff.on_exception(backoff.constant,
                       (ssh_exception.NoValidConnectionsError, TimeoutError))
-def bootstrap_instance(instance: 'Instance', route_rule: str):
+def bootstrap_instance(pool: SSHPool,
+                       instance: 'Instance',
+                       route_rule: str,
+                       bundle: SourceBundle,
+                       image: ImageArchive | None = None):
+    """Start the app of `bundle` on `instance`, from the prebuilt `image` if
+    given, otherwise from an image built on the instance. See
+    `deploy.ready` to wait until it serves."""
     logger.info(f"Bootstrapping {instance=}")
-    ssh_key = RSAKey.from_private_key_file(f'{AWS_KEY_PAIR_NAME}.pem')
-    with SSHClient() as ssh_client:
-        ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-        ssh_client.connect(
-            hostname=instance.public_ip_address,
-            username=SSH_USERNAME,
-            pkey=ssh_key,
-        )
-        _setup_docker(ssh_client)
-        _push_sources(ssh_client)
-        _build_app(ssh_client)
-        _start_app(ssh_client, instance.id, route_rule)
-    _check_app(instance, route_rule)
+    host = instance.public_ip_address
+    _setup_docker(pool, host)
+    if image is not None:
+        upload_image(pool, host, image)
+    else:
+        _push_sources(pool, host, bundle)
+        _build_app(pool, host)
+    _start_app(pool, host, instance.id, route_rule)
+    _set_deployed_digest(pool, host, bundle.digest)
+
+
+async def deployed_digests(pool: SSHPool, instances: list['Instance']):
+    """Digest of the source bundle running on each instance, by ID, if any"""
+    outputs = await pool.fan_out(
+        [inst.public_ip_address for inst in instances],
+        f"sudo docker container inspect -f '{{{{.State.Running}}}}' app "
+        f"2>/dev/null | grep -q true && cat {DEPLOYED_DIGEST_PATH}",
+        stream=False, check=False)
+    return {inst.id: outputs[inst.public_ip_address].strip() or None
+            for inst in instances}
 
 
 @backoff.on_exception(backoff.constant, SSHExecError)
-def _setup_docker(ssh_client: SSHClient):
+def _setup_docker(pool: SSHPool, host: str):
     logger.info('Setting up docker')
-    ssh_exec(ssh_client, r'sudo snap install docker')
+    pool.exec(host, r'sudo snap install docker')
 
 
-def _push_sources(ssh_client: SSHClient):
+def _push_sources(pool: SSHPool, host: str, bundle: SourceBundle):
     logger.info('Pushing sources')
-    with ssh_client.open_sftp() as sftp:
-        with io.BytesIO() as f:
-            with tarfile.open(fileobj=f, mode='w:gz') as tar:
-                tar.add('pyproject.toml')
-                tar.add('poetry.lock')
-                tar.add('app/')
-                tar.add('.docker/app.Dockerfile')
-            f.seek(0)
-            sftp.putfo(f, 'src.tar.gz')
+    with pool.client(host).open_sftp() as sftp:
+        sftp.putfo(io.BytesIO(bundle.data), 'src.tar.gz')
 
 
 @backoff.on_exception(backoff.constant, SSHExecError)
-def _build_app(ssh_client: SSHClient):
+def _build_app(pool: SSHPool, host: str):
     logger.info('Building app')
-    ssh_exec(
-        ssh_client, r"""
+    pool.exec(
+        host, rf"""
             rm -rf src && mkdir -p src
             tar xzf src.tar.gz -C src/
-            sudo docker build -t app -f src/.docker/app.Dockerfile src/
+            sudo docker build -t {APP_IMAGE} -f src/.docker/app.Dockerfile src/
             """)
 
 
 @backoff.on_exception(backoff.constant, SSHExecError)
-def _start_app(ssh_client: SSHClient, instance_id: str, route_rule: str):
+def _start_app(pool: SSHPool, host: str, instance_id: str, route_rule: str):
     logger.info('Start app')
-    ssh_exec(
-        ssh_client,
+    app_env = ''.join(f"-e {shlex.quote(f'{name}={value}')} "
+                      for name, value in APP_ENV.items())
+    pool.exec(
+        host,
         rf"""
         sudo docker rm -f app
         sudo docker run --name app -d -p 80:8000 \
             -e INSTANCE_ID={instance_id} \
             -e ROUTE_RULE={route_rule} \
-            app
+            {app_env}{APP_IMAGE}
         """)
 
 
-@backoff.on_exception(backoff.constant, (requests.HTTPError, requests.ConnectionError))
-def _check_app(instance: 'Instance', route_rule: str):
-    request_url = f'http://{instance.public_ip_address}{route_rule}'
-    logger.info(f'Checking app at {request_url}')
-    response = requests.get(request_url)
-    response.raise_for_status()
-    logger.info(response.text)
+def _set_deployed_digest(pool: SSHPool, host: str, digest: str):
+    pool.exec(host, f"echo {digest} > {DEPLOYED_DIGEST_PATH}")
@@ -0,0 +1,51 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import tarfile
+from dataclasses import dataclass
+from pathlib import Path
+
+from deploy.config import APP_ENV
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ('pyproject.toml', 'poetry.lock', 'app', '.docker/app.Dockerfile')
+
+
+@dataclass
+class SourceBundle:
+    """Sources of the app image as a tar.gz, and a digest of the sources and
+    of the `APP_*` settings of the containers"""
+    data: bytes
+    digest: str
+
+
+def make_source_bundle():
+    """Bundle the sources once for all the instances. The archive only
+    depends on the content of the files, so that its digest only changes
+    with them."""
+    files = sorted(
+        path for source in SOURCES
+        for path in ([Path(source)] if Path(source).is_file()
+                     else Path(source).rglob('*'))
+        if path.is_file() and '__pycache__' not in path.parts)
+    with io.BytesIO() as tar_data:
+        with tarfile.open(fileobj=tar_data, mode='w',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for path in files:
+                info = tar.gettarinfo(str(path), arcname=path.as_posix())
+                info.mtime = 0
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                info.mode = 0o644
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+        tar_bytes = tar_data.getvalue()
+    digest = hashlib.sha256(tar_bytes)
+    digest.update(json.dumps(APP_ENV, sort_keys=True).encode())
+    bundle = SourceBundle(gzip.compress(tar_bytes, mtime=0),
+                          digest.hexdigest())
+    logger.info(f"Source bundle: {len(files)} files, {bundle.digest}")
+    return bundle
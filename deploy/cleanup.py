@@ -1,6 +1,7 @@
+import asyncio
 import logging
+import time
 
-import backoff
 from botocore.exceptions import ClientError
 
 from deploy.config import (
@@ -9,26 +10,29 @@ from deploy.config import (
     AWS_SECURITY_GROUP_NAME,
     LOG_LEVEL,
 )
-from deploy.utils import ec2_res, elbv2_cli, get_error_code
+from deploy.utils import Steps, ec2_cli, ec2_res, elbv2_cli, get_error_code
 
 logger = logging.getLogger(__name__)
 
-
-def giveup(e: Exception):
-    return not (isinstance(e, ClientError) and
-                (get_error_code(e) in ('DependencyViolation', 'ResourceInUse')))
+WAITER_CONFIG = {'Delay': 5, 'MaxAttempts': 120}
+# Seconds between checks of the network interfaces left by a load balancer
+ENI_POLL_INTERVAL = 5
 
 
 def terminate_ec2():
     instances = ec2_res.instances.filter(
         Filters=[
             {'Name': 'tag:Name', 'Values': [AWS_RES_NAME]},
-            {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+            {'Name': 'instance-state-name',
+             'Values': ['pending', 'running', 'stopping', 'stopped']},
         ]
     )
-    for inst in instances:
-        logger.info(f"Terminating instance: {inst}")
-        inst.terminate()
+    ids = [inst.id for inst in instances]
+    if ids:
+        logger.info(f"Terminating instances: {ids}")
+        ec2_cli.terminate_instances(InstanceIds=ids)
+        ec2_cli.get_waiter('instance_terminated').wait(
+            InstanceIds=ids, WaiterConfig=WAITER_CONFIG)
 
 
 def delete_lb():
@@ -41,20 +45,28 @@ def delete_lb():
                 raise RuntimeError('Load balancer ARN not found')
             logger.info(f"Deleting load balancer: {arn}")
             elbv2_cli.delete_load_balancer(LoadBalancerArn=arn)
+            elbv2_cli.get_waiter('load_balancers_deleted').wait(
+                LoadBalancerArns=[arn], WaiterConfig=WAITER_CONFIG)
             break
 
 
-@backoff.on_exception(backoff.constant, ClientError, giveup=giveup)
-def delete_target_groups():
+def delete_target_group(arn: str):
+    """Delete a target group, once no load balancer forwards to it"""
+    logger.info(f"Deleting target group: {arn}")
+    elbv2_cli.delete_target_group(TargetGroupArn=arn)
+
+
+def get_target_groups():
     target_groups = elbv2_cli.describe_target_groups()
+    arns = []
     for tg in target_groups['TargetGroups']:
         name = tg.get('TargetGroupName')
         if name is not None and name.startswith(AWS_RES_NAME):
             arn = tg.get('TargetGroupArn')
             if arn is None:
                 raise RuntimeError('Target group ARN not found')
-            logger.info(f"Deleting target group: {arn}")
-            elbv2_cli.delete_target_group(TargetGroupArn=arn)
+            arns.append(arn)
+    return arns
 
 
 def delete_key_pair():
@@ -71,13 +83,15 @@ def delete_key_pair():
             raise
 
 
-@backoff.on_exception(backoff.constant, ClientError, giveup=giveup)
 def delete_security_groups():
+    """Delete the security group, once the instances are terminated and the
+    network interfaces of the load balancer are released"""
     try:
         security_groups = ec2_res.security_groups.filter(
             GroupNames=[AWS_SECURITY_GROUP_NAME],
         )
         for sg in security_groups:
+            _wait_network_interfaces_released(sg.id)
             logger.info(f"Deleting security group: {sg}")
             sg.delete()
     except ClientError as e:
@@ -86,14 +100,37 @@ def delete_security_groups():
             raise
 
 
-def main():
-    terminate_ec2()
-    delete_lb()
-    delete_target_groups()
-    delete_key_pair()
-    delete_security_groups()
+def _wait_network_interfaces_released(sg_id: str):
+    """The network interfaces of a load balancer outlive it for a while, and
+    there is no waiter for them: wait as long as the waiters do"""
+    deadline = time.monotonic() \
+        + WAITER_CONFIG['Delay'] * WAITER_CONFIG['MaxAttempts']
+    while ec2_cli.describe_network_interfaces(
+            Filters=[{'Name': 'group-id', 'Values': [sg_id]}],
+    )['NetworkInterfaces']:
+        if time.monotonic() >= deadline:
+            raise TimeoutError(
+                f"Network interfaces of {sg_id} still in use")
+        logger.info(f"Waiting for the network interfaces of {sg_id}")
+        time.sleep(ENI_POLL_INTERVAL)
+
+
+async def main():
+    """Delete the resources, each one as soon as nothing depends on it"""
+    async with asyncio.TaskGroup() as tg:
+        steps = Steps(tg)
+        instances = steps.add('instances', terminate_ec2)
+        lb = steps.add('load balancer', delete_lb)
+        target_groups = steps.add('list target groups', get_target_groups)
+        steps.add('key pair', delete_key_pair)
+        steps.add('security group', delete_security_groups,
+                  after=(instances, lb))
+        for arn in await target_groups:
+            steps.add(f"target group {arn.rsplit('/', 2)[-2]}",
+                      delete_target_group, arn=arn, after=(lb,))
+    steps.log_timings()
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=LOG_LEVEL)
-    main()
+    asyncio.run(main())
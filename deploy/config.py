@@ -13,3 +13,36 @@ M4_L_NB = 5
 T2_L_NB = 4
 IMAGE_ID = 'ami-053b0d53c279acc90'  # ubuntu 22.04
 SSH_USERNAME = 'ubuntu'
+# Instances bootstrapped or running a command at the same time
+SSH_CONCURRENCY = 16
+
+# The app image is built once locally for the platform of the instances, then
+# uploaded to all of them as a compressed `docker save` archive.
+# DEPLOY_BUILD_ON_INSTANCES=1 builds it from the sources on each instance.
+BUILD_ON_INSTANCES = os.environ.get('DEPLOY_BUILD_ON_INSTANCES') == '1'
+APP_IMAGE = 'app'
+IMAGE_PLATFORM = 'linux/amd64'
+IMAGE_ARCHIVE_DIR = '.cache/images'
+
+# gunicorn settings passed to the app containers (see app/gunicorn_conf.py),
+# e.g. APP_WORKER_CLASS=gevent python3 -m deploy
+APP_ENV = {name: value for name, value in os.environ.items()
+           if name.startswith('APP_')}
+
+HEALTH_CHECK_PATH = '/health'
+# A target is healthy after HEALTHY_THRESHOLD successful health checks
+HEALTH_CHECK_INTERVAL = 5
+HEALTHY_THRESHOLD = 2
+# Readiness of the targets after a deployment: overall timeout (s), longest
+# delay between two polls (s) and timeout of a request to an instance (s)
+READY_TIMEOUT = 600
+READY_MAX_DELAY = 10
+READY_REQUEST_TIMEOUT = 5
+# Seconds the load balancer lets in flight requests of a deregistered target
+# complete (300 by default), which bounds the time of a rolling restart
+DEREGISTRATION_DELAY = 10
+# Listener rules of the load balancer: (priority, path patterns, target group)
+LISTENER_RULES = [
+    (1, ['/cluster1', '/cluster1/*'], f'{AWS_RES_NAME}-1'),
+    (2, ['/cluster2', '/cluster2/*'], f'{AWS_RES_NAME}-2'),
+]
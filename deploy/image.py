@@ -0,0 +1,87 @@
+import gzip
+import hashlib
+import logging
+import shutil
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+
+import backoff
+
+from deploy.config import APP_IMAGE, IMAGE_ARCHIVE_DIR, IMAGE_PLATFORM
+from deploy.ssh import SSHPool
+from deploy.utils import SSHExecError
+
+logger = logging.getLogger(__name__)
+
+REMOTE_ARCHIVE = 'app.tar.gz'
+
+
+@dataclass
+class ImageArchive:
+    """Compressed `docker save` archive of the app image"""
+    path: Path
+    image_id: str
+    sha256: str
+
+
+def build_image():
+    """Build the app image locally and save it, unless an archive of the
+    same image already exists"""
+    logger.info('Building app image')
+    subprocess.run(
+        ['docker', 'build', '--platform', IMAGE_PLATFORM,
+         '-t', APP_IMAGE, '-f', '.docker/app.Dockerfile', '.'],
+        check=True)
+    image_id = subprocess.run(
+        ['docker', 'image', 'inspect', '--format', '{{.Id}}', APP_IMAGE],
+        check=True, capture_output=True, text=True).stdout.strip()
+
+    directory = Path(IMAGE_ARCHIVE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{image_id.removeprefix('sha256:')}.tar.gz"
+    if not path.exists():
+        logger.info(f"Saving {image_id} to {path}")
+        tmp_path = path.with_suffix('.tmp')
+        with subprocess.Popen(['docker', 'save', APP_IMAGE],
+                              stdout=subprocess.PIPE) as save, \
+                gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+            assert save.stdout is not None
+            shutil.copyfileobj(save.stdout, f, 1 << 20)
+        if save.returncode != 0:
+            raise subprocess.CalledProcessError(save.returncode, save.args)
+        tmp_path.rename(path)
+    with open(path, 'rb') as f:
+        sha256 = hashlib.file_digest(f, 'sha256').hexdigest()
+    logger.info(f"App image archive: {path} ({path.stat().st_size} bytes)")
+    return ImageArchive(path, image_id, sha256)
+
+
+@backoff.on_exception(backoff.constant, SSHExecError, max_tries=3)
+def upload_image(pool: SSHPool, host: str, archive: ImageArchive):
+    """Upload the archive, unless the instance already has it, and load it.
+    An archive that fails to load is removed, so that a retry uploads it
+    again."""
+    remote_sha256 = pool.exec(
+        host, f"sha256sum {REMOTE_ARCHIVE} 2>/dev/null",
+        stream=False, check=False).split(' ', 1)[0]
+    if remote_sha256 != archive.sha256:
+        logger.info(f"Uploading {archive.path} to {host}")
+        with pool.client(host).open_sftp() as sftp:
+            sftp.put(str(archive.path), REMOTE_ARCHIVE)
+    try:
+        _load_image(pool, host, archive)
+    except SSHExecError:
+        pool.exec(host, f"rm -f {REMOTE_ARCHIVE}", stream=False, check=False)
+        raise
+
+
+def _load_image(pool: SSHPool, host: str, archive: ImageArchive):
+    logger.info(f"Loading {archive.image_id}")
+    pool.exec(
+        host, rf"""
+            set -e
+            echo '{archive.sha256}  {REMOTE_ARCHIVE}' | sha256sum -c
+            gunzip -c {REMOTE_ARCHIVE} | sudo docker load
+            test "$(sudo docker image inspect --format '{{{{.Id}}}}' {APP_IMAGE})" = '{archive.image_id}'
+            """)  # noqa: E501
@@ -1,39 +1,164 @@
 import asyncio
 import logging
-from itertools import chain
+from collections import Counter
+from pathlib import Path
 from typing import TYPE_CHECKING
 
+from botocore.exceptions import ClientError
+
 from deploy.config import (
     AWS_KEY_PAIR_NAME,
     AWS_RES_NAME,
     AWS_SECURITY_GROUP_NAME,
+    DEREGISTRATION_DELAY,
     DEV,
+    HEALTH_CHECK_INTERVAL,
+    HEALTH_CHECK_PATH,
+    HEALTHY_THRESHOLD,
     IMAGE_ID,
+    LISTENER_RULES,
     M4_L_NB,
     T2_L_NB,
 )
-from deploy.utils import ec2_cli, ec2_res, elbv2_cli, get_default_vpc, wait_instance
+from deploy.utils import (
+    Steps,
+    ec2_cli,
+    ec2_res,
+    elbv2_cli,
+    get_default_vpc,
+    get_error_code,
+    wait_instances,
+)
 
 if TYPE_CHECKING:
     from mypy_boto3_ec2.service_resource import Instance, KeyPair, SecurityGroup, Vpc
 
 logger = logging.getLogger(__name__)
 
+INGRESS_PORTS = (22, 80)
+
+# Instances of each target group: (target group, instance type, number,
+# whether to go through the availability zones in reverse order)
+CLUSTERS = [
+    (f'{AWS_RES_NAME}-1', 'm4.large', M4_L_NB, False),
+    (f'{AWS_RES_NAME}-2', 't2.large', T2_L_NB, True),
+]
+
 
-async def setup_infra():
-    vpc = get_default_vpc()
-    kp = _setup_key_pair()
-    sg = _setup_security_group(vpc)
-    instances_m4, instances_t2 = _launch_instances(sg, kp)
+async def setup_infra(reconcile: bool = False):
+    """Create the resources, each one as soon as the resources it depends on
+    exist: the load balancer and the target groups are created while the
+    instances boot, and the instances of a zone are launched at once.
+
+    With `reconcile`, the existing resources are reused and only the
+    difference with the desired state is created, changed or deleted.
+    """
+    zones = _get_availability_zones()
+    existing = _get_instances() if reconcile else []
+    excess = []
     async with asyncio.TaskGroup() as tg:
-        for inst in chain(instances_m4, instances_t2):
-            tg.create_task(asyncio.to_thread(wait_instance, inst))
-    _setup_load_balancer(sg, vpc, instances_m4, instances_t2)
+        steps = Steps(tg)
+        vpc = steps.add('default VPC', get_default_vpc)
+        kp = steps.add('key pair', _setup_key_pair, reconcile=reconcile)
+        sg = steps.add('security group', _setup_security_group, vpc,
+                       reconcile=reconcile)
+        lb = steps.add('load balancer', _create_load_balancer, sg, vpc,
+                       reconcile=reconcile)
+        listener = steps.add('listener', _create_listener, lb,
+                             reconcile=reconcile)
+        if reconcile:
+            steps.add('delete other rules', _delete_other_rules, listener)
+        batches = {}
+        deregistered = []
+        for tg_name, instance_type, nb, reverse in CLUSTERS:
+            tg_arn = steps.add(f'target group {tg_name}',
+                               _create_target_group, vpc, name=tg_name,
+                               reconcile=reconcile)
+            batches[tg_name] = []
+            wanted = _place_instances(zones[::-1] if reverse else zones,
+                                      nb if not DEV else 1)
+            kept = []
+            launches = []
+            for zone in zones:
+                in_zone = [inst for inst in existing
+                           if inst.instance_type == instance_type
+                           and inst.placement['AvailabilityZone'] == zone]
+                kept += in_zone[:wanted[zone]]
+                excess += in_zone[wanted[zone]:]
+                count = wanted[zone] - len(in_zone)
+                if count > 0:
+                    launches.append((zone, count))
+            # Register the targets only once the other ones are
+            # deregistered, so that the deregistration cannot remove them
+            register_after = ()
+            if reconcile:
+                deregister = steps.add(
+                    f'deregister other targets of {tg_name}',
+                    _deregister_other_targets, tg_arn,
+                    instance_ids={inst.id for inst in kept})
+                deregistered.append(deregister)
+                register_after = (deregister,)
+            for zone, count in launches:
+                launched = steps.add(
+                    f'launch {count} {instance_type} in {zone}',
+                    _launch_instances, sg, kp, instance_type=instance_type,
+                    zone=zone, count=count)
+                running = steps.add(
+                    f'wait {instance_type} in {zone}', wait_instances,
+                    launched)
+                steps.add(f'register {instance_type} in {zone}',
+                          _register_targets, tg_arn, running,
+                          after=register_after)
+                batches[tg_name].append(running)
+            if kept:
+                running = steps.add(
+                    f'wait {len(kept)} existing {instance_type}',
+                    wait_instances, instances=kept)
+                steps.add(f'register existing {instance_type}',
+                          _register_targets, tg_arn, running,
+                          after=register_after)
+                batches[tg_name].append(running)
+            for priority, path_patterns, rule_tg_name in LISTENER_RULES:
+                if rule_tg_name == tg_name:
+                    steps.add(f'rule {priority}', _create_rule, listener,
+                              tg_arn, priority=priority,
+                              path_patterns=path_patterns,
+                              reconcile=reconcile)
+        instance_types = {instance_type for _, instance_type, _, _ in CLUSTERS}
+        excess += [inst for inst in existing
+                   if inst.instance_type not in instance_types]
+        if excess:
+            steps.add(f'terminate {len(excess)} excess instances',
+                      _terminate_instances, after=tuple(deregistered),
+                      instances=excess)
+    steps.log_timings()
+    instances_m4, instances_t2 = (
+        [inst for batch in batches[tg_name] for inst in batch.result()]
+        for tg_name, _, _, _ in CLUSTERS)
     return instances_m4, instances_t2
 
 
-def _setup_key_pair():
+def _get_instances():
+    """Instances of a previous deployment"""
+    return list(ec2_res.instances.filter(
+        Filters=[
+            {'Name': 'tag:Name', 'Values': [AWS_RES_NAME]},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+        ]
+    ))
+
+
+def _setup_key_pair(reconcile: bool = False):
     logger.info('Setting up key pair')
+    if reconcile:
+        key_pairs = ec2_cli.describe_key_pairs(Filters=[
+            {'Name': 'key-name', 'Values': [AWS_KEY_PAIR_NAME]},
+        ])['KeyPairs']
+        if key_pairs:
+            if not Path(f'{AWS_KEY_PAIR_NAME}.pem').exists():
+                raise RuntimeError(f'Key pair {AWS_KEY_PAIR_NAME} exists but '
+                                   f'{AWS_KEY_PAIR_NAME}.pem was not found')
+            return ec2_res.KeyPair(AWS_KEY_PAIR_NAME)
     key_pair = ec2_res.create_key_pair(KeyName=AWS_KEY_PAIR_NAME)
 
     with open(f'{AWS_KEY_PAIR_NAME}.pem', 'w') as f:
@@ -42,110 +167,105 @@ def _setup_key_pair():
     return key_pair
 
 
-def _setup_security_group(vpc: 'Vpc'):
+def _setup_security_group(vpc: 'Vpc', reconcile: bool = False):
     logger.info('Setting up security group')
-    sg = ec2_res.create_security_group(
-        GroupName=AWS_SECURITY_GROUP_NAME,
-        Description=AWS_SECURITY_GROUP_NAME,
-        VpcId=vpc.id,
-    )
-    sg.authorize_ingress(
-        IpPermissions=[
-            {
-                "FromPort": 22,
-                "ToPort": 22,
-                "IpProtocol": "tcp",
-                "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
-            },
-            {
-                "FromPort": 80,
-                "ToPort": 80,
-                "IpProtocol": "tcp",
-                "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
-            },
-        ],
-    )
+    sgs = list(vpc.security_groups.filter(Filters=[
+        {'Name': 'group-name', 'Values': [AWS_SECURITY_GROUP_NAME]},
+    ])) if reconcile else []
+    if sgs:
+        sg = sgs[0]
+    else:
+        sg = ec2_res.create_security_group(
+            GroupName=AWS_SECURITY_GROUP_NAME,
+            Description=AWS_SECURITY_GROUP_NAME,
+            VpcId=vpc.id,
+        )
+    for port in INGRESS_PORTS:
+        try:
+            sg.authorize_ingress(
+                IpPermissions=[
+                    {
+                        "FromPort": port,
+                        "ToPort": port,
+                        "IpProtocol": "tcp",
+                        "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
+                    },
+                ],
+            )
+        except ClientError as e:
+            if get_error_code(e) != 'InvalidPermission.Duplicate':
+                raise
     return sg
 
 
-def _launch_instances(sg: 'SecurityGroup', kp: 'KeyPair'):
-    logger.info('Launching instances')
-
-    avail_zones = [zone['ZoneName']
-                   for zone
-                   in ec2_cli.describe_availability_zones()['AvailabilityZones']
-                   if 'ZoneName' in zone]
-
-    instances_m4 = []
-    for i in range(M4_L_NB if not DEV else 1):
-        zone = avail_zones[i % len(avail_zones)]
-        instances = ec2_res.create_instances(
-            KeyName=kp.key_name,
-            SecurityGroupIds=[sg.id],
-            InstanceType='m4.large',
-            ImageId=IMAGE_ID,
-            MaxCount=1,
-            MinCount=1,
-            Placement={'AvailabilityZone': zone},
-            TagSpecifications=[{
-                'ResourceType': 'instance',
-                'Tags': [
-                    {'Key': 'Name', 'Value': AWS_RES_NAME},
-                ]
-            }]
-        )
-        instances_m4 += instances
-
-    instances_t2 = []
-    for i in range(T2_L_NB if not DEV else 1):
-        zone = avail_zones[-1 - i % len(avail_zones)]  # reverse order
-        instances = ec2_res.create_instances(
-            KeyName=kp.key_name,
-            SecurityGroupIds=[sg.id],
-            InstanceType='t2.large',
-            ImageId=IMAGE_ID,
-            MaxCount=1,
-            MinCount=1,
-            Placement={'AvailabilityZone': zone},
-            TagSpecifications=[{
-                'ResourceType': 'instance',
-                'Tags': [
-                    {'Key': 'Name', 'Value': AWS_RES_NAME},
-                ]
-            }]
-        )
-        instances_t2 += instances
+def _get_availability_zones():
+    return [zone['ZoneName']
+            for zone
+            in ec2_cli.describe_availability_zones()['AvailabilityZones']
+            if 'ZoneName' in zone]
 
-    return instances_m4, instances_t2
 
+def _place_instances(zones: list[str], nb: int):
+    """Number of instances per zone, spreading them over the zones"""
+    return Counter(zones[i % len(zones)] for i in range(nb))
 
-def _setup_load_balancer(sg: 'SecurityGroup',
-                         vpc: 'Vpc',
-                         cluster1_instances: list['Instance'],
-                         cluster2_instances: list['Instance']):
-    logger.info('Setting up load balancer')
-    subnets = [subnet.id for subnet in vpc.subnets.all()]
-    lb = elbv2_cli.create_load_balancer(
-        Name=AWS_RES_NAME,
-        Subnets=subnets,
-        SecurityGroups=[sg.id],
+
+def _launch_instances(sg: 'SecurityGroup',
+                      kp: 'KeyPair',
+                      instance_type: str,
+                      zone: str,
+                      count: int):
+    logger.info(f'Launching {count} {instance_type} instances in {zone}')
+    return ec2_res.create_instances(
+        KeyName=kp.key_name,
+        SecurityGroupIds=[sg.id],
+        InstanceType=instance_type,
+        ImageId=IMAGE_ID,
+        MaxCount=count,
+        MinCount=count,
+        Placement={'AvailabilityZone': zone},
+        TagSpecifications=[{
+            'ResourceType': 'instance',
+            'Tags': [
+                {'Key': 'Name', 'Value': AWS_RES_NAME},
+            ]
+        }]
     )
+
+
+def _create_load_balancer(sg: 'SecurityGroup',
+                          vpc: 'Vpc',
+                          reconcile: bool = False):
+    logger.info('Setting up load balancer')
+    lb = _describe(elbv2_cli.describe_load_balancers, 'LoadBalancers',
+                   'LoadBalancerNotFound', Names=[AWS_RES_NAME]) \
+        if reconcile else None
+    if lb is None:
+        subnets = [subnet.id for subnet in vpc.subnets.all()]
+        lb = elbv2_cli.create_load_balancer(
+            Name=AWS_RES_NAME,
+            Subnets=subnets,
+            SecurityGroups=[sg.id],
+        )['LoadBalancers'][0]
     logger.debug(lb)
-    lb_arn = lb['LoadBalancers'][0].get('LoadBalancerArn')
+    lb_arn = lb.get('LoadBalancerArn')
     if lb_arn is None:
         raise RuntimeError('Load balancer ARN not found')
-    lb_dns = lb['LoadBalancers'][0].get('DNSName')
+    lb_dns = lb.get('DNSName')
     if lb_dns is None:
         raise RuntimeError('Load balancer DNS not found')
     logger.info(f'Load balancer DNS: {lb_dns}')
+    return lb_arn
 
-    logger.info('Setting up target groups')
-    tg1_arn = _create_target_group(
-        f'{AWS_RES_NAME}-1', vpc, cluster1_instances)
-    tg2_arn = _create_target_group(
-        f'{AWS_RES_NAME}-2', vpc, cluster2_instances)
 
+def _create_listener(lb_arn: str, reconcile: bool = False):
     logger.info('Setting up listener')
+    listeners = elbv2_cli.describe_listeners(
+        LoadBalancerArn=lb_arn)['Listeners'] if reconcile else []
+    listeners = [listener for listener in listeners
+                 if listener.get('Port') == 80]
+    if listeners:
+        return listeners[0]['ListenerArn']
     listener = elbv2_cli.create_listener(
         LoadBalancerArn=lb_arn,
         Protocol='HTTP',
@@ -162,42 +282,110 @@ def _setup_load_balancer(sg: 'SecurityGroup',
     listener_arn = listener['Listeners'][0].get('ListenerArn')
     if listener_arn is None:
         raise RuntimeError('Listener ARN not found')
-    elbv2_cli.create_rule(
-        ListenerArn=listener_arn,
-        Conditions=[
-            {'Field': 'path-pattern', 'Values': ['/cluster1', '/cluster1/*']},
-        ],
-        Priority=1,
-        Actions=[
-            {'Type': 'forward', 'TargetGroupArn': tg1_arn},
-        ],
-    )
-    elbv2_cli.create_rule(
-        ListenerArn=listener_arn,
-        Conditions=[
-            {'Field': 'path-pattern', 'Values': ['/cluster2', '/cluster2/*']},
-        ],
-        Priority=2,
-        Actions=[
-            {'Type': 'forward', 'TargetGroupArn': tg2_arn},
-        ],
-    )
+    return listener_arn
 
-    return lb_arn
 
+def _create_rule(listener_arn: str,
+                 tg_arn: str,
+                 priority: int,
+                 path_patterns: list[str],
+                 reconcile: bool = False):
+    conditions = [{'Field': 'path-pattern', 'Values': path_patterns}]
+    actions = [{'Type': 'forward', 'TargetGroupArn': tg_arn}]
+    rules = [rule for rule in _describe_rules(listener_arn)
+             if rule.get('Priority') == str(priority)] if reconcile else []
+    if not rules:
+        elbv2_cli.create_rule(
+            ListenerArn=listener_arn,
+            Conditions=conditions,
+            Priority=priority,
+            Actions=actions,
+        )
+        return
+    rule = rules[0]
+    if [(cond.get('Field'), sorted(cond.get('Values', [])))
+            for cond in rule.get('Conditions', [])] \
+            != [('path-pattern', sorted(path_patterns))] \
+            or [(action.get('Type'), action.get('TargetGroupArn'))
+                for action in rule.get('Actions', [])] \
+            != [('forward', tg_arn)]:
+        logger.info(f'Updating rule {priority}')
+        elbv2_cli.modify_rule(RuleArn=rule['RuleArn'],
+                              Conditions=conditions, Actions=actions)
 
-def _create_target_group(name: str, vpc: 'Vpc', instances: list['Instance']):
-    resp = elbv2_cli.create_target_group(
-        Name=name,
-        Protocol='HTTP',
-        Port=80,
-        VpcId=vpc.id,
-        HealthCheckPath='/health',
-    )
-    arn = resp['TargetGroups'][0].get('TargetGroupArn')
+
+def _delete_other_rules(listener_arn: str):
+    priorities = {str(priority) for priority, _, _ in LISTENER_RULES}
+    for rule in _describe_rules(listener_arn):
+        if not rule.get('IsDefault') and rule.get('Priority') not in priorities:
+            logger.info(f"Deleting rule {rule.get('Priority')}")
+            elbv2_cli.delete_rule(RuleArn=rule['RuleArn'])
+
+
+def _describe_rules(listener_arn: str):
+    return elbv2_cli.describe_rules(ListenerArn=listener_arn)['Rules']
+
+
+def _create_target_group(vpc: 'Vpc', name: str, reconcile: bool = False):
+    logger.info(f'Setting up target group {name}')
+    health_check = {
+        'HealthCheckPath': HEALTH_CHECK_PATH,
+        'HealthCheckIntervalSeconds': HEALTH_CHECK_INTERVAL,
+        'HealthyThresholdCount': HEALTHY_THRESHOLD,
+    }
+    target_group = _describe(elbv2_cli.describe_target_groups, 'TargetGroups',
+                             'TargetGroupNotFound', Names=[name]) \
+        if reconcile else None
+    if target_group is None:
+        target_group = elbv2_cli.create_target_group(
+            Name=name,
+            Protocol='HTTP',
+            Port=80,
+            VpcId=vpc.id,
+            **health_check,
+        )['TargetGroups'][0]
+    elif any(target_group.get(key) != value
+             for key, value in health_check.items()):
+        elbv2_cli.modify_target_group(
+            TargetGroupArn=target_group['TargetGroupArn'], **health_check)
+    arn = target_group.get('TargetGroupArn')
     if arn is None:
         raise RuntimeError('Target group ARN not found')
-    elbv2_cli.register_targets(TargetGroupArn=arn, Targets=[
+    elbv2_cli.modify_target_group_attributes(
+        TargetGroupArn=arn,
+        Attributes=[{'Key': 'deregistration_delay.timeout_seconds',
+                     'Value': str(DEREGISTRATION_DELAY)}],
+    )
+    return arn
+
+
+def _register_targets(tg_arn: str, instances: list['Instance']):
+    elbv2_cli.register_targets(TargetGroupArn=tg_arn, Targets=[
         {'Id': inst.id, 'Port': 80} for inst in instances
     ])
-    return arn
+
+
+def _deregister_other_targets(tg_arn: str, instance_ids: set[str]):
+    health = elbv2_cli.describe_target_health(TargetGroupArn=tg_arn)
+    targets = [desc['Target'] for desc in health['TargetHealthDescriptions']
+               if desc['Target']['Id'] not in instance_ids]
+    if targets:
+        logger.info(f"Deregistering {[target['Id'] for target in targets]}")
+        elbv2_cli.deregister_targets(TargetGroupArn=tg_arn, Targets=targets)
+
+
+def _terminate_instances(instances: list['Instance']):
+    ids = [inst.id for inst in instances]
+    logger.info(f'Terminating excess instances {ids}')
+    ec2_cli.terminate_instances(InstanceIds=ids)
+
+
+def _describe(describe, key: str, not_found_code: str, **kwargs):
+    """First resource described by `describe`, or None if there is none"""
+    try:
+        resources = describe(**kwargs)[key]
+    except ClientError as e:
+        if get_error_code(e) != not_found_code:
+            raise
+        return None
+    return resources[0] if resources else None
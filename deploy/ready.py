@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import random
+from itertools import count
+from typing import TYPE_CHECKING
+
+import aiohttp
+import backoff
+
+from deploy.config import (
+    LISTENER_RULES,
+    READY_MAX_DELAY,
+    READY_REQUEST_TIMEOUT,
+    READY_TIMEOUT,
+)
+from deploy.utils import elbv2_cli
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.service_resource import Instance
+
+logger = logging.getLogger(__name__)
+
+
+async def wait_ready(targets: list[tuple['Instance', str]]):
+    """Wait until the app answers on each (instance, route rule) of
+    `targets`, then until all the targets of the target groups are healthy.
+    Log how long each target took to be ready."""
+    start = asyncio.get_running_loop().time()
+    app_ready = await wait_apps(targets)
+    healthy = await wait_targets_healthy()
+    lines = [f"{inst.id}: app {app_ready[inst.id] - start:6.1f} s, "
+             f"healthy {healthy[inst.id] - start:6.1f} s"
+             for inst, _ in targets if inst.id in healthy]
+    logger.info('Targets ready:\n' + '\n'.join(lines))
+
+
+async def wait_apps(targets: list[tuple['Instance', str]]):
+    """Poll the app of all the instances at once, with jittered exponential
+    backoff. Return the (event loop) time each instance answered, by ID."""
+    timeout = aiohttp.ClientTimeout(total=READY_REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with asyncio.TaskGroup() as tg:
+            tasks = {inst.id: tg.create_task(_wait_app(session, inst, route))
+                     for inst, route in targets}
+    return {instance_id: task.result() for instance_id, task in tasks.items()}
+
+
+@backoff.on_exception(backoff.expo,
+                      (aiohttp.ClientError, asyncio.TimeoutError),
+                      max_time=READY_TIMEOUT,
+                      max_value=READY_MAX_DELAY)
+async def _wait_app(session: aiohttp.ClientSession,
+                    instance: 'Instance',
+                    route_rule: str):
+    url = f'http://{instance.public_ip_address}{route_rule}'
+    async with session.get(url, raise_for_status=True) as resp:
+        logger.info(f"{instance.id}: {await resp.text()}")
+    return asyncio.get_running_loop().time()
+
+
+async def wait_targets_healthy():
+    """Wait until the load balancer reports all the registered targets of
+    the target groups healthy, deregistered ones being allowed to drain,
+    and each target group has one at least. Return the (event loop) time
+    each target was first seen healthy, by ID."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + READY_TIMEOUT
+    tg_arns = await asyncio.to_thread(_get_tg_arns)
+    healthy: dict[str, float] = {}
+    for attempt in count():
+        states = await asyncio.gather(
+            *(asyncio.to_thread(_target_states, tg_arn)
+              for tg_arn in tg_arns))
+        now = loop.time()
+        for tg_states in states:
+            for target_id, state in tg_states.items():
+                if state == 'healthy':
+                    healthy.setdefault(target_id, now)
+        unhealthy = _not_ready(tg_arns, states)
+        if not unhealthy:
+            return healthy
+        if now >= deadline:
+            raise TimeoutError(f"Targets not healthy: {unhealthy}")
+        logger.info(f"Waiting for targets: {unhealthy}")
+        await asyncio.sleep(
+            random.uniform(0, min(2 ** attempt, READY_MAX_DELAY)))
+
+
+def _get_tg_arns():
+    """ARN of each target group, several listener rules possibly forwarding
+    to the same one"""
+    tg_names = dict.fromkeys(tg_name for _, _, tg_name in LISTENER_RULES)
+    return [
+        elbv2_cli.describe_target_groups(
+            Names=[tg_name])['TargetGroups'][0]['TargetGroupArn']
+        for tg_name in tg_names
+    ]
+
+
+def _not_ready(tg_arns: list[str], states: list[dict[str, str | None]]):
+    """State of the targets that are not ready, by ID, and of the target
+    groups without any registered target (draining ones excepted), by ARN"""
+    unhealthy = {target_id: state
+                 for tg_states in states
+                 for target_id, state in tg_states.items()
+                 if state not in ('healthy', 'draining')}
+    for tg_arn, tg_states in zip(tg_arns, states):
+        if all(state == 'draining' for state in tg_states.values()):
+            unhealthy[tg_arn] = 'no registered target'
+    return unhealthy
+
+
+def _target_states(tg_arn: str):
+    health = elbv2_cli.describe_target_health(TargetGroupArn=tg_arn)
+    return {desc['Target']['Id']: desc.get('TargetHealth', {}).get('State')
+            for desc in health['TargetHealthDescriptions']}
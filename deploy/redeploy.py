@@ -0,0 +1,118 @@
+"""Redeploy the app on the instances of the target groups whose app differs
+from the local sources, one instance of each target group at a time
+
+python3 -m deploy.redeploy [--force]
+"""
+import argparse
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+from deploy.bootstrap import bootstrap_instance, deployed_digests
+from deploy.bundle import SourceBundle, make_source_bundle
+from deploy.config import BUILD_ON_INSTANCES, LISTENER_RULES, LOG_LEVEL
+from deploy.image import ImageArchive, build_image
+from deploy.ready import wait_apps, wait_targets_healthy
+from deploy.ssh import SSHPool
+from deploy.utils import ec2_res, elbv2_cli
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.service_resource import Instance
+
+logger = logging.getLogger(__name__)
+
+WAITER_CONFIG = {'Delay': 5, 'MaxAttempts': 60}
+
+
+async def main(force: bool = False):
+    bundle = make_source_bundle()
+    clusters = _get_clusters()
+    instances = [inst for _, _, insts in clusters for inst in insts]
+    with SSHPool() as pool:
+        digests = await deployed_digests(pool, instances)
+        stale = [(tg_arn, route_rule,
+                  [inst for inst in insts
+                   if force or digests[inst.id] != bundle.digest])
+                 for tg_arn, route_rule, insts in clusters]
+        nb_stale = sum(len(insts) for _, _, insts in stale)
+        logger.info(f"{nb_stale} of {len(instances)} instances to redeploy")
+        if nb_stale == 0:
+            return
+
+        image = None if BUILD_ON_INSTANCES \
+            else await asyncio.to_thread(build_image)
+        async with asyncio.TaskGroup() as tg:
+            for tg_arn, route_rule, insts in stale:
+                tg.create_task(_rolling_restart(
+                    pool, tg_arn, route_rule, insts, bundle, image))
+
+
+def _get_clusters():
+    """(target group ARN, route rule, instances) of each target group"""
+    clusters = []
+    for _, path_patterns, tg_name in LISTENER_RULES:
+        tg_arn = elbv2_cli.describe_target_groups(
+            Names=[tg_name])['TargetGroups'][0]['TargetGroupArn']
+        health = elbv2_cli.describe_target_health(TargetGroupArn=tg_arn)
+        instance_ids = [desc['Target']['Id']
+                        for desc in health['TargetHealthDescriptions']]
+        instances = list(ec2_res.instances.filter(InstanceIds=instance_ids)) \
+            if instance_ids else []
+        clusters.append((tg_arn, path_patterns[0], instances))
+    return clusters
+
+
+async def _rolling_restart(pool: SSHPool,
+                           tg_arn: str,
+                           route_rule: str,
+                           instances: list['Instance'],
+                           bundle: SourceBundle,
+                           image: ImageArchive | None):
+    """Restart the instances one by one, so that the other ones of the
+    target group keep serving"""
+    for inst in instances:
+        targets = [{'Id': inst.id, 'Port': 80}]
+        await pool.call(_redeploy_target, pool, tg_arn, inst, route_rule,
+                        bundle, image)
+        await wait_apps([(inst, route_rule)])
+        logger.info(f"Registering {inst.id}")
+        await asyncio.to_thread(elbv2_cli.register_targets,
+                                TargetGroupArn=tg_arn, Targets=targets)
+        await wait_targets_healthy()
+
+
+def _redeploy_target(pool: SSHPool,
+                     tg_arn: str,
+                     instance: 'Instance',
+                     route_rule: str,
+                     bundle: SourceBundle,
+                     image: ImageArchive | None):
+    """Deregister the instance while it restarts, unless no other target
+    would serve meanwhile: it is then restarted in place"""
+    targets = [{'Id': instance.id, 'Port': 80}]
+    if _other_healthy_targets(tg_arn, instance.id):
+        logger.info(f"Deregistering {instance.id}")
+        elbv2_cli.deregister_targets(TargetGroupArn=tg_arn, Targets=targets)
+        elbv2_cli.get_waiter('target_deregistered').wait(
+            TargetGroupArn=tg_arn, Targets=targets, WaiterConfig=WAITER_CONFIG)
+    else:
+        logger.warning(f"No other healthy target in {tg_arn}, "
+                       f"restarting {instance.id} in place")
+    bootstrap_instance(pool, instance, route_rule, bundle, image)
+
+
+def _other_healthy_targets(tg_arn: str, instance_id: str):
+    health = elbv2_cli.describe_target_health(TargetGroupArn=tg_arn)
+    return [desc['Target']['Id']
+            for desc in health['TargetHealthDescriptions']
+            if desc['Target']['Id'] != instance_id
+            and desc.get('TargetHealth', {}).get('State') == 'healthy']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python3 -m deploy.redeploy')
+    parser.add_argument('--force', action='store_true',
+                        help='redeploy the instances already up to date')
+    args = parser.parse_args()
+    logging.basicConfig(level=LOG_LEVEL)
+    asyncio.run(main(args.force))
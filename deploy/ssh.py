@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Any, Callable
+
+import backoff
+from paramiko import AutoAddPolicy, RSAKey, SSHClient, ssh_exception
+
+from deploy.config import AWS_KEY_PAIR_NAME, SSH_CONCURRENCY, SSH_USERNAME
+from deploy.utils import ssh_exec
+
+logger = logging.getLogger(__name__)
+
+
+class SSHPool:
+    """One authenticated SSH connection per host, kept open across all the
+    phases of a deployment. Commands run on channels of these connections.
+
+    `call` and `fan_out` run blocking functions in threads, at most
+    `concurrency` at a time.
+    """
+
+    def __init__(self, concurrency: int = SSH_CONCURRENCY):
+        self._key: RSAKey | None = None
+        self._clients: dict[str, SSHClient] = {}
+        self._locks: defaultdict[str, threading.Lock] = \
+            defaultdict(threading.Lock)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @backoff.on_exception(backoff.constant,
+                          (ssh_exception.NoValidConnectionsError, TimeoutError))
+    def client(self, host: str):
+        """Connection to `host`, opened again if it was lost"""
+        with self._locks[host]:
+            client = self._clients.get(host)
+            transport = client.get_transport() if client is not None else None
+            if transport is None or not transport.is_active():
+                logger.info(f"Connecting to {host}")
+                client = SSHClient()
+                client.set_missing_host_key_policy(AutoAddPolicy())
+                client.connect(hostname=host, username=SSH_USERNAME,
+                               pkey=self._get_key())
+                self._clients[host] = client
+            return client
+
+    def exec(self, host: str, cmd: str, stream: bool = True,
+             check: bool = True):
+        """Run `cmd` on `host`, its output being logged after the host"""
+        return ssh_exec(self.client(host), cmd, prefix=f'[{host}] ',
+                        stream=stream, check=check)
+
+    async def call(self, func: Callable[..., Any], *args, **kwargs):
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def fan_out(self, hosts: list[str], cmd: str, **kwargs):
+        """Run `cmd` on all `hosts`, returning the stdout of each"""
+        outputs = await asyncio.gather(
+            *(self.call(self.exec, host, cmd, **kwargs) for host in hosts))
+        return dict(zip(hosts, outputs))
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
+
+    def _get_key(self):
+        if self._key is None:
+            self._key = RSAKey.from_private_key_file(
+                f'{AWS_KEY_PAIR_NAME}.pem')
+        return self._key
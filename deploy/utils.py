@@ -1,5 +1,8 @@
+import asyncio
 import logging
-from typing import TYPE_CHECKING
+import select
+import time
+from typing import TYPE_CHECKING, Any, Callable
 
 import boto3
 from botocore.exceptions import ClientError
@@ -14,6 +17,11 @@ ec2_cli = boto3.client('ec2')
 ec2_res = boto3.resource('ec2')
 elbv2_cli = boto3.client('elbv2')
 
+SSH_POLL_INTERVAL = .1
+SSH_READ_SIZE = 32768
+# Lines of stderr in the message of SSHExecError
+SSH_ERROR_LINES = 20
+
 
 def get_default_vpc():
     vpcs_desc = ec2_cli.describe_vpcs(
@@ -27,22 +35,107 @@ def get_default_vpc():
     return vpc
 
 
-def wait_instance(instance: 'Instance'):
-    logger.info(f'Waiting for {instance=} to be ready')
-    instance.wait_until_running()
-    instance.reload()
+def wait_instances(instances: list['Instance']):
+    """Wait until the instances run, polling them all at once"""
+    logger.info(f'Waiting for {instances=} to be ready')
+    ec2_cli.get_waiter('instance_running').wait(
+        InstanceIds=[inst.id for inst in instances],
+        WaiterConfig={'Delay': 5, 'MaxAttempts': 120})
+    for inst in instances:
+        inst.reload()
+    return instances
+
+
+class Steps:
+    """Dependency graph of blocking steps run in threads of a task group.
+
+    A step starts as soon as the steps it depends on are done, and gets
+    their results as its first arguments. It also waits for the steps
+    `after`, without getting their results. `timings` holds the start and end
+    of each step in seconds from the creation of the graph.
+    """
+
+    def __init__(self, tg: asyncio.TaskGroup):
+        self.tg = tg
+        self.start = time.perf_counter()
+        self.timings: dict[str, tuple[float, float]] = {}
+
+    def add(self,
+            name: str,
+            func: Callable[..., Any],
+            /,
+            *deps: asyncio.Task,
+            after: tuple[asyncio.Task, ...] = (),
+            **kwargs):
+        async def run():
+            args = [await dep for dep in deps]
+            for task in after:
+                await task
+            start = time.perf_counter() - self.start
+            result = await asyncio.to_thread(func, *args, **kwargs)
+            end = time.perf_counter() - self.start
+            self.timings[name] = (start, end)
+            logger.info(f"{name}: done in {end - start:.1f} s")
+            return result
+
+        return self.tg.create_task(run(), name=name)
+
+    def log_timings(self):
+        lines = [f"{start:7.1f} s {end:7.1f} s {end - start:7.1f} s  {name}"
+                 for name, (start, end)
+                 in sorted(self.timings.items(), key=lambda item: item[1])]
+        logger.info('Steps (start, end, duration):\n' + '\n'.join(lines))
 
 
 class SSHExecError(RuntimeError):
     pass
 
 
-def ssh_exec(ssh_client: SSHClient, cmd: str):
-    stdin, stdout, stderr = ssh_client.exec_command(cmd, get_pty=True)
-    status = stdout.channel.recv_exit_status()
-    logger.info('\n' + stdout.read().decode().strip())
-    if status != 0:
-        raise SSHExecError(stderr.read().decode())
+def ssh_exec(ssh_client: SSHClient,
+             cmd: str,
+             prefix: str = '',
+             stream: bool = True,
+             check: bool = True):
+    """Run `cmd` on a channel of `ssh_client` and return its stdout.
+
+    With `stream`, stdout and stderr are logged line by line as they come,
+    after `prefix`. With `check`, a non-zero exit status raises SSHExecError
+    with the end of stderr.
+    """
+    transport = ssh_client.get_transport()
+    if transport is None:
+        raise SSHExecError('SSH client is not connected')
+    lines: dict[bool, list[str]] = {False: [], True: []}
+    partial = {False: b'', True: b''}
+
+    def feed(data: bytes, is_stderr: bool, final: bool = False):
+        *complete, partial[is_stderr] = (partial[is_stderr] + data).split(b'\n')
+        if final and partial[is_stderr]:
+            complete.append(partial[is_stderr])
+        for line in complete:
+            text = line.decode(errors='replace').rstrip('\r')
+            lines[is_stderr].append(text)
+            if stream:
+                logger.log(logging.WARNING if is_stderr else logging.INFO,
+                           f'{prefix}{text}')
+
+    with transport.open_session() as channel:
+        channel.exec_command(cmd)
+        while True:
+            select.select([channel], [], [], SSH_POLL_INTERVAL)
+            while channel.recv_ready():
+                feed(channel.recv(SSH_READ_SIZE), False)
+            while channel.recv_stderr_ready():
+                feed(channel.recv_stderr(SSH_READ_SIZE), True)
+            if channel.exit_status_ready() and not channel.recv_ready() \
+                    and not channel.recv_stderr_ready():
+                break
+        feed(b'', False, final=True)
+        feed(b'', True, final=True)
+        status = channel.recv_exit_status()
+    if check and status != 0:
+        raise SSHExecError('\n'.join(lines[True][-SSH_ERROR_LINES:]))
+    return '\n'.join(lines[False])
 
 
 def get_error_code(e: ClientError):